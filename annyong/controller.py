@@ -0,0 +1,46 @@
+BUTTONS = ('a', 'b', 'select', 'start', 'up', 'down', 'left', 'right')
+
+def buttons_mask(names):
+    # The buttons bitmask for an iterable of BUTTONS names.
+    mask = 0
+    for name in names:
+        mask |= 1 << BUTTONS.index(name)
+    return mask
+
+class Controller(object):
+    """
+    A standard joypad, read a bit at a time through $4016 (or $4017).
+
+    `buttons` is what the host has pressed, a bit per BUTTONS entry (A in
+    bit 0). While the strobe bit written to $4016 is set the shift register
+    keeps reloading from it; once it's cleared every read shifts one button
+    out, and reads past the eighth return 1 like the real thing.
+    """
+
+    def __init__(self):
+        self.buttons = 0
+        self.strobe = False
+        self.shift = 0
+
+    def reset(self):
+        self.buttons = 0
+        self.strobe = False
+        self.shift = 0
+
+    def write(self, value):
+        self.strobe = bool(value & 1)
+        if self.strobe:
+            self.shift = self.buttons
+
+    def read(self):
+        if self.strobe:
+            return self.buttons & 1
+        bit = self.shift & 1
+        self.shift = (self.shift >> 1) | 0x80
+        return bit
+
+    def snapshot(self):
+        return (self.buttons, self.strobe, self.shift)
+
+    def restore(self, state):
+        self.buttons, self.strobe, self.shift = state
@@ -0,0 +1,250 @@
+from annyong.mpu.mpu6502 import Mpu6502
+from annyong.util.compat import xrange
+
+class Break(BaseException):
+    def __init__(self, reason, point=None, address=None, value=None):
+        # reason is 'breakpoint', 'read', 'write' or 'step'. For watchpoints,
+        # address and value are the access that triggered it.
+        self.reason = reason
+        self.point = point
+        self.address = address
+        self.value = value
+        self.pc = None
+
+    def __str__(self):
+        string = '%s at $%04X' % (self.reason, self.pc)
+        if self.address is not None:
+            string += ' ($%04X = $%02X)' % (self.address, self.value)
+        return string
+
+class Breakpoint(object):
+    def __init__(self, pc, condition):
+        self.pc = pc
+        self.condition = condition
+        self.hits = 0
+
+class Watchpoint(object):
+    def __init__(self, start, end, read, write, condition):
+        self.start = start
+        self.end = end
+        self.read = read
+        self.write = write
+        self.condition = condition
+        self.hits = 0
+
+def register_condition(**registers):
+    # A condition that holds when the registers (pc, a, x, y, sp or ps) have
+    # the given values.
+    names = {'pc': 'pc', 'a': 'ac', 'x': 'x', 'y': 'y', 'sp': 'sp', 'ps': 'ps'}
+    expected = [(names[name], value) for name, value in registers.items()]
+
+    def condition(mpu):
+        for attr, value in expected:
+            if int(getattr(mpu.reg, attr)) != value:
+                return False
+        return True
+    return condition
+
+class Debugger(object):
+    """
+    PC breakpoints and read/write watchpoints that cost nothing where there
+    are none.
+
+    Both work by wrapping the memory subscribers of the addresses involved
+    (and only those); everything else runs exactly as before. A breakpoint
+    sees the opcode fetch of its address and stops before the instruction
+    runs. A watchpoint fires in the middle of an instruction, so it only
+    replaces the mpu's step() until the next instruction boundary, where the
+    break happens. Conditions are called with the mpu, e.g.
+    register_condition(a=0x10).
+
+    Breaks are raised as Break out of whatever is running the NES; run() and
+    step() catch them. The NES picks up where it stopped the next time it
+    runs. Points have to be added after the ROM is loaded, since loading it
+    resets the subscribers, and don't mix with run-ahead.
+    """
+
+    def __init__(self, nes):
+        self.nes = nes
+        self.breakpoints = []
+        self.watchpoints = []
+        self.last_break = None
+        # offset -> (original subscriber, [points])
+        self._read_hooks = {}
+        self._write_hooks = {}
+        self._pending = None
+        self._steps_left = None
+        # (pc, cycles) of the last breakpoint, which shouldn't fire again when
+        # execution resumes right there.
+        self._resume = None
+
+    def add_breakpoint(self, pc, condition=None):
+        point = Breakpoint(pc, condition)
+        self.breakpoints.append(point)
+        self._hook(self._read_hooks, pc, point)
+        return point
+
+    def add_watchpoint(self, start, end=None, read=False, write=True,
+                       condition=None):
+        # Watches start up to (not including) end.
+        if end is None:
+            end = start + 1
+        point = Watchpoint(start, end, read, write, condition)
+        self.watchpoints.append(point)
+        for offset in xrange(start, end):
+            if read:
+                self._hook(self._read_hooks, offset, point)
+            if write:
+                self._hook(self._write_hooks, offset, point)
+        return point
+
+    def remove(self, point):
+        if isinstance(point, Breakpoint):
+            self.breakpoints.remove(point)
+            self._unhook(self._read_hooks, point.pc, point)
+        else:
+            self.watchpoints.remove(point)
+            for offset in xrange(point.start, point.end):
+                if point.read:
+                    self._unhook(self._read_hooks, offset, point)
+                if point.write:
+                    self._unhook(self._write_hooks, offset, point)
+
+    def clear(self):
+        for point in self.breakpoints + self.watchpoints:
+            self.remove(point)
+
+    def reset(self):
+        # clear(), and also forgets a break that hasn't been raised yet and
+        # the last one, as if the debugger was new.
+        self.clear()
+        self.last_break = None
+        self._pending = None
+        self._steps_left = None
+        self._resume = None
+        self._uninstall_step()
+
+    def run(self, frames=None):
+        # Runs the NES for `frames` frames (forever if None). Returns the
+        # Break that stopped it, or None.
+        return self._catch(self.nes.run_frames, frames)
+
+    def step(self, count=1):
+        # Runs `count` instructions, or up to a break if that comes first.
+        self._steps_left = count
+        self._install_step()
+        try:
+            return self._catch(self.nes.run_frames, None)
+        finally:
+            self._steps_left = None
+            self._uninstall_step()
+
+    def _catch(self, fn, *args):
+        try:
+            fn(*args)
+        except Break as e:
+            e.pc = self.nes.mpu.reg.pc
+            self.last_break = e
+            return e
+        return None
+
+    # subscriber wrappers {{{
+
+    def _hook(self, hooks, offset, point):
+        if offset in hooks:
+            hooks[offset][1].append(point)
+            return
+
+        memory = self.nes.mpu.memory
+        if hooks is self._read_hooks:
+            original = memory.replace_read_subscriber(offset, self._on_read)
+        else:
+            original = memory.replace_write_subscriber(offset, self._on_write)
+        hooks[offset] = (original, [point])
+
+    def _unhook(self, hooks, offset, point):
+        original, points = hooks[offset]
+        points.remove(point)
+        if points:
+            return
+
+        del hooks[offset]
+        memory = self.nes.mpu.memory
+        if hooks is self._read_hooks:
+            memory.replace_read_subscriber(offset, original)
+        else:
+            memory.replace_write_subscriber(offset, original)
+
+    def _on_read(self, offset):
+        mpu = self.nes.mpu
+        original, points = self._read_hooks[offset]
+        fetch = offset == (mpu.reg.pc - 1) & 0xFFFF
+
+        if fetch and self._resume != (offset, mpu.cycles):
+            for point in points:
+                if isinstance(point, Breakpoint) and self._check(point, mpu):
+                    # Nothing has happened yet but the increment of PC.
+                    mpu.reg.pc = offset
+                    self._resume = (offset, mpu.cycles)
+                    raise Break('breakpoint', point)
+
+        if original:
+            value = original(offset)
+        else:
+            value = mpu.memory.peek(offset)
+
+        for point in points:
+            if isinstance(point, Watchpoint) and self._check(point, mpu):
+                self._break_later(Break('read', point, offset, value))
+        return value
+
+    def _on_write(self, offset, value):
+        mpu = self.nes.mpu
+        original, points = self._write_hooks[offset]
+        if original:
+            original(offset, value=value)
+        else:
+            mpu.memory.poke(offset, value)
+
+        for point in points:
+            if self._check(point, mpu):
+                self._break_later(Break('write', point, offset, value))
+
+    def _check(self, point, mpu):
+        if point.condition and not point.condition(mpu):
+            return False
+        point.hits += 1
+        return True
+
+    # }}}
+    # step() replacement {{{
+
+    def _break_later(self, e):
+        # Breaks at the next instruction boundary. The first hit wins.
+        if self._pending is None:
+            self._pending = e
+            self._install_step()
+
+    def _install_step(self):
+        self.nes.mpu.step = self._step
+
+    def _uninstall_step(self):
+        mpu = self.nes.mpu
+        if (self._pending is None and self._steps_left is None and
+                'step' in vars(mpu)):
+            del mpu.step
+
+    def _step(self):
+        mpu = self.nes.mpu
+        if self._pending is not None:
+            e, self._pending = self._pending, None
+            self._uninstall_step()
+            raise e
+
+        if self._steps_left is not None and not mpu.halt_cycles:
+            if not self._steps_left:
+                raise Break('step')
+            self._steps_left -= 1
+        return Mpu6502.step(mpu)
+
+    # }}}
@@ -0,0 +1,263 @@
+"""
+Finds where two NES configurations (e.g. two PPU engines) stop agreeing.
+
+Both run the same inputs in lockstep, and their states are compared every
+`interval` frames. Only when a checkpoint differs is the work narrowed down:
+both go back to the last checkpoint that matched and compare after every
+frame, then back to the start of the first frame that differs, where a binary
+search over the number of instructions run finds the first one after which
+they differ. Checking a whole corpus mostly costs the two runs themselves.
+"""
+
+import zlib
+from array import array
+
+from annyong.mpu.debug import disassemble
+from annyong.replay import state_checksum
+from annyong.util.compat import array_tobytes
+
+def mpu_checksum(nes):
+    """
+    CRC-32 of the mpu's registers and memory only. The PPU engines update
+    loopy_v and friends at different points of a scanline, so comparing them
+    with state_checksum() finds that first; this finds where the game starts
+    doing something else.
+    """
+    reg = nes.mpu.reg
+    crc = zlib.crc32(repr((
+        reg.pc, reg.sp, reg.ac, reg.x, reg.y, int(reg.ps), nes.mpu.cycles,
+    )).encode('ascii'))
+    crc = zlib.crc32(array_tobytes(nes.mpu.memory.snapshot()), crc)
+    return crc & 0xFFFFFFFF
+
+CHECKSUMS = {
+    'full': state_checksum,
+    'mpu': mpu_checksum,
+}
+
+def registers(mpu):
+    # The register file, formatted like the trace.
+    reg = mpu.reg
+    flags = ''
+    for key, val in (('negative', 'n'), ('overflow', 'v'), ('sixth', 'u'),
+                     ('break_', 'b'), ('decimal', 'd'), ('interrupt', 'i'),
+                     ('zero', 'z'), ('carry', 'c')):
+        flags += val.upper() if getattr(reg.ps, key) else val
+    return 'PC:%04X A:%02X X:%02X Y:%02X S:%02X P:%s CYC:%d' % (
+        reg.pc, reg.ac, reg.x, reg.y, reg.sp, flags, mpu.cycles)
+
+def instruction(mpu):
+    # The instruction at PC, disassembled, without side effects.
+    pc = mpu.reg.pc
+    opcode = mpu.memory.peek(pc)
+    if not mpu._opcodes[opcode]:
+        return '%04X  %02X        ???' % (pc, opcode)
+    num_operands = mpu._opcodes[opcode][1].num_operands
+    operands = [mpu.memory.peek((pc + i) & 0xFFFF)
+                for i in range(1, num_operands + 1)]
+    return '%04X  %02X %s  %s' % (
+        pc, opcode, ' '.join('%02X' % o for o in operands).ljust(5),
+        disassemble(mpu, opcode, operands, False).strip())
+
+# Names for the fields of the snapshot tuples that have them.
+_FIELDS = {
+    'mpu': ('pc', 'sp', 'ac', 'x', 'y', 'ps', 'cycles', 'halt_cycles',
+            'memory'),
+    'ppu.regs': ('ctrlreg1', 'ctrlreg2', 'statusreg'),
+}
+
+def differences(a, b, limit=10):
+    """
+    Where the snapshots of a and b differ, as 'path: a != b' strings (at most
+    `limit`). The engines' own state and the screen are left out.
+    """
+    found = []
+
+    def compare(path, x, y):
+        if len(found) >= limit:
+            return
+        if isinstance(x, dict):
+            for key in sorted(x):
+                if key not in ('engine', 'screen'):
+                    compare('%s.%s' % (path, key) if path else key,
+                            x[key], y[key])
+        elif isinstance(x, array):
+            for i, (u, v) in enumerate(zip(x, y)):
+                if u != v and len(found) < limit:
+                    found.append('%s[$%04X]: $%02X != $%02X' % (path, i, u, v))
+        elif isinstance(x, (list, tuple)):
+            names = _FIELDS.get(path)
+            for i, (u, v) in enumerate(zip(x, y)):
+                compare('%s.%s' % (path, names[i]) if names else
+                        '%s[%d]' % (path, i), u, v)
+        elif x != y:
+            found.append('%s: %r != %r' % (path, x, y))
+
+    compare('', a.snapshot(), b.snapshot())
+    return found
+
+class Divergence(object):
+    def __init__(self, frame_num, instructions):
+        # The first frame after which the states differ, and how many of its
+        # instructions run before they do; None when they only differ at the
+        # end of the frame, and 0 when they do before its first instruction
+        # (e.g. the engines start the frame differently).
+        self.frame_num = frame_num
+        self.instructions = instructions
+        # The instruction that makes them differ.
+        self.disassembly = None
+        # The register files of a and b, before and after it.
+        self.before = None
+        self.after = None
+        self.differences = None
+
+    def __str__(self):
+        lines = ['diverged in frame %d' % self.frame_num]
+        if self.instructions:
+            lines[0] += ', after instruction %d:' % self.instructions
+            lines.append('  %s' % self.disassembly)
+            lines.append('  before  %s' % self.before[0])
+            if self.before[1] != self.before[0]:
+                lines.append('          %s' % self.before[1])
+        elif self.instructions == 0:
+            lines[0] += ', before its first instruction'
+        else:
+            lines[0] += ', at its end'
+        if self.after:
+            lines.append('  a       %s' % self.after[0])
+            lines.append('  b       %s' % self.after[1])
+        lines.extend('  %s' % line for line in self.differences)
+        return '\n'.join(lines)
+
+class Lockstep(object):
+    """
+    Runs two NES instances, with the same ROM loaded, on the same inputs.
+
+    inputs are the joypads' buttons for every frame, as in Replay.inputs;
+    both start from `snapshot` if given and from power on otherwise. Neither
+    should have sinks, debugger points or run-ahead, and rendering is
+    skipped while this runs since the screen isn't compared.
+    """
+
+    def __init__(self, a, b, inputs, snapshot=None, checksum=state_checksum):
+        self.a = a
+        self.b = b
+        self.inputs = inputs
+        self.checksum = checksum
+        # The number of frames and instructions emulated, by each of them.
+        self.frames_run = 0
+        self.instructions_run = 0
+        for nes in (a, b):
+            if snapshot is not None:
+                nes.restore(snapshot)
+            else:
+                nes.power_cycle()
+                nes.mpu.interrupt('reset')
+        self.start_frame = a.frame_num
+
+    def run(self, interval=60):
+        # Returns the first Divergence, or None when the two agree after
+        # every frame.
+        a, b = self.a, self.b
+        skip_rendering = (a.ppu.skip_rendering, b.ppu.skip_rendering)
+        a.ppu.skip_rendering = b.ppu.skip_rendering = True
+        try:
+            checkpoint = self._snapshots()
+            for i in range(len(self.inputs)):
+                self._frame()
+                frame_num = a.frame_num
+                if ((frame_num - self.start_frame) % interval and
+                        i != len(self.inputs) - 1):
+                    continue
+                if self._match():
+                    checkpoint = self._snapshots()
+                    continue
+                return self._narrow_frames(checkpoint, frame_num)
+            return None
+        finally:
+            a.ppu.skip_rendering, b.ppu.skip_rendering = skip_rendering
+
+    def _snapshots(self):
+        return (self.a.snapshot(), self.b.snapshot())
+
+    def _restore(self, snapshots):
+        self.a.restore(snapshots[0])
+        self.b.restore(snapshots[1])
+
+    def _match(self):
+        return self.checksum(self.a) == self.checksum(self.b)
+
+    def _buttons(self):
+        # Sets the buttons of the frame a is about to run.
+        buttons = self.inputs[self.a.frame_num - self.start_frame]
+        for nes in (self.a, self.b):
+            for controller, pressed in zip(nes.controllers, buttons):
+                controller.buttons = pressed
+
+    def _frame(self):
+        self._buttons()
+        self.a.emulate_frame()
+        self.b.emulate_frame()
+        self.frames_run += 1
+
+    def _narrow_frames(self, checkpoint, end):
+        # Frame by frame from the last checkpoint that matched, up to the
+        # one that didn't.
+        self._restore(checkpoint)
+        while True:
+            start = self._snapshots()
+            self._frame()
+            if not self._match() or self.a.frame_num == end:
+                break
+        return self._narrow_instructions(start)
+
+    def _narrow_instructions(self, start):
+        # start matches and the frame after it doesn't. Finds the smallest
+        # count of instructions into the frame after which they differ; the
+        # search assumes that once the states differ they stay different.
+        frame_num = start[0]['frame_num'] + 1
+        divergence = Divergence(frame_num, None)
+        if self._differ_after(start, 0):
+            divergence.instructions = 0
+        else:
+            # Doubling up to about the length of the frame, since the end of
+            # the frame (where they're known to differ) isn't at a fixed
+            # instruction count.
+            good, bad = 0, 1
+            while not self._differ_after(start, bad):
+                if self.a.frame_num > frame_num:
+                    bad = None
+                    break
+                good, bad = bad, bad * 2
+            while bad is not None and bad - good > 1:
+                middle = (good + bad) // 2
+                if self._differ_after(start, middle):
+                    bad = middle
+                else:
+                    good = middle
+            divergence.instructions = bad
+
+        if divergence.instructions:
+            self._differ_after(start, divergence.instructions - 1)
+            divergence.disassembly = instruction(self.a.mpu)
+            divergence.before = (registers(self.a.mpu),
+                                 registers(self.b.mpu))
+            self._differ_after(start, divergence.instructions)
+        elif divergence.instructions is None:
+            self._restore(start)
+            self._frame()
+        else:
+            self._differ_after(start, 0)
+        divergence.after = (registers(self.a.mpu), registers(self.b.mpu))
+        divergence.differences = differences(self.a, self.b)
+        return divergence
+
+    def _differ_after(self, start, count):
+        # Restores start and runs count instructions of the next frame on
+        # both, leaving them in the middle of it.
+        self._restore(start)
+        self._buttons()
+        for nes in (self.a, self.b):
+            nes.debugger.step(count)
+        self.instructions_run += count
+        return not self._match()
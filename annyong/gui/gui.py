@@ -1,21 +1,122 @@
+import threading
+import time
+from timeit import default_timer
+
 import wx
 
+from annyong.ppu.palette import screen_to_rgb
+from annyong.util.compat import queue, xrange
+
+class EmulationThread(threading.Thread):
+    """
+    Runs the NES in its own thread and publishes every finished frame.
+
+    The gui never waits on the emulator and the emulator never waits on the
+    gui; they only share `frame`, which is replaced (not modified) for every
+    frame, so reading it is safe without locking. Anything that touches the
+    NES from the gui goes through call(), and is run between two frames.
+    """
+
+    def __init__(self, nes, limit_speed=True):
+        super(EmulationThread, self).__init__(name='annyong-emulation')
+        self.daemon = True
+        self.nes = nes
+        self.limit_speed = limit_speed
+        # (frame number, RGB buffer) of the last finished frame.
+        self.frame = None
+        self.fps = 0.0
+        self._commands = queue.Queue()
+        self._running = True
+
+    def call(self, fn, *args):
+        self._commands.put((fn, args))
+
+    def stop(self):
+        self._running = False
+
+    def _run_commands(self):
+        while True:
+            try:
+                fn, args = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            fn(*args)
+
+    def run(self):
+        nes = self.nes
+        deadline = fps_start = default_timer()
+        fps_frames = 0
+
+        while self._running:
+            self._run_commands()
+            nes.frame()
+            self.frame = (nes.frame_num, screen_to_rgb(nes.ppu))
+
+            now = default_timer()
+            fps_frames += 1
+            if now - fps_start >= 1.0:
+                self.fps = fps_frames / (now - fps_start)
+                fps_start, fps_frames = now, 0
+
+            if self.limit_speed:
+                deadline += nes.FRAME_TIME
+                if deadline > now:
+                    time.sleep(deadline - now)
+                else:
+                    # We've fallen behind; run at whatever speed we can
+                    # instead of trying to catch up in a burst.
+                    deadline = now
+
 class GUI(wx.Frame):
-    def __init__(self, nes):
+    # The screen is repainted at (roughly) the NTSC refresh rate, but only
+    # when the emulator has published a new frame. wx has no way to wait for
+    # the real vertical blank, so this is as close as we get.
+    REFRESH_MS = 16
+
+    def __init__(self, nes, scale=2):
         super(GUI, self).__init__(
             parent=None,
-            style=wx.SYSTEM_MENU | wx.CAPTION | wx.CLOSE_BOX,
-            size=(256, 240),
+            style=wx.SYSTEM_MENU | wx.CAPTION | wx.CLOSE_BOX |
+                  wx.MINIMIZE_BOX,
+            title='Annyong',
         )
 
         self.nes = nes
+        self.scale = scale
+        self.bitmap = None
+        self.shown_frame_num = None
+        self.emulation = EmulationThread(nes)
+
         self.SetMenuBar(self._make_menubar())
+        self.CreateStatusBar()
+
+        self.screen = wx.Panel(self)
+        self.screen.SetBackgroundStyle(wx.BG_STYLE_PAINT)
+        self.screen.Bind(wx.EVT_PAINT, self.on_paint)
+        self._resize()
+
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+
+        self.emulation.start()
+        self.timer.Start(GUI.REFRESH_MS)
 
     def _make_menubar(self):
         file = wx.Menu()
-        file.Append(-1, '&Load rom')
-        file.Append(-1, '&Reset NES')
-        file.Append(-1, '&Quit Annyong')
+        self.Bind(wx.EVT_MENU, self.on_load_rom,
+                  file.Append(wx.ID_ANY, '&Load rom'))
+        self.Bind(wx.EVT_MENU, self.on_reset,
+                  file.Append(wx.ID_ANY, '&Reset NES'))
+        self.Bind(wx.EVT_MENU, lambda event: self.Close(),
+                  file.Append(wx.ID_EXIT, '&Quit Annyong'))
+
+        view = wx.Menu()
+        for scale in xrange(1, 5):
+            item = view.AppendRadioItem(wx.ID_ANY, '&%dx' % scale)
+            item.Check(scale == self.scale)
+            self.Bind(wx.EVT_MENU,
+                      lambda event, scale=scale: self.set_scale(scale), item)
 
         ppu = wx.Menu()
         ppu.Append(-1, 'Debug &nametable')
@@ -23,15 +124,72 @@ class GUI(wx.Frame):
 
         menubar = wx.MenuBar()
         menubar.Append(file, '&File')
+        menubar.Append(view, '&View')
         menubar.Append(ppu, '&PPU')
         return menubar
 
-def main(nes):
+    def _resize(self):
+        size = (256 * self.scale, 240 * self.scale)
+        self.screen.SetMinSize(size)
+        self.screen.SetSize(size)
+        self.SetClientSize(size)
+
+    def set_scale(self, scale):
+        self.scale = scale
+        self._resize()
+        self.screen.Refresh(eraseBackground=False)
+
+    def on_load_rom(self, event):
+        dialog = wx.FileDialog(self, 'Load rom', wildcard='*.nes',
+                               style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+        if dialog.ShowModal() == wx.ID_OK:
+            self.emulation.call(self._load_rom, dialog.GetPath())
+        dialog.Destroy()
+
+    def _load_rom(self, path):
+        # Runs in the emulation thread.
+        self.nes.load_rom(path)
+        self.nes.mpu.interrupt('reset')
+
+    def on_reset(self, event):
+        self.emulation.call(self.nes.mpu.interrupt, 'reset')
+
+    def on_timer(self, event):
+        frame = self.emulation.frame
+        if frame is None or frame[0] == self.shown_frame_num:
+            return
+
+        self.shown_frame_num, rgb = frame
+        self.bitmap = wx.Bitmap.FromBuffer(256, 240, rgb)
+        self.screen.Refresh(eraseBackground=False)
+        self.SetStatusText('Frame %d, %.1f fps' % (
+            self.shown_frame_num, self.emulation.fps
+        ))
+
+    def on_paint(self, event):
+        dc = wx.AutoBufferedPaintDC(self.screen)
+        dc.SetBackground(wx.BLACK_BRUSH)
+        dc.Clear()
+        if self.bitmap is not None:
+            dc.SetUserScale(self.scale, self.scale)
+            dc.DrawBitmap(self.bitmap, 0, 0)
+
+    def on_close(self, event):
+        self.timer.Stop()
+        self.emulation.stop()
+        self.emulation.join(1.0)
+        self.Destroy()
+
+def main(nes, scale=2):
     app = wx.App()
-    gui = GUI(nes)
+    nes.mpu.interrupt('reset')
+    gui = GUI(nes, scale)
     gui.Show()
     app.MainLoop()
 
 if __name__ == '__main__':
+    import sys
     from annyong.nes import NES
-    main(NES())
+    nes = NES()
+    nes.load_rom(sys.argv[1])
+    main(nes)
@@ -0,0 +1,164 @@
+"""
+Per address read/write counters for a Memory, and a file format for them.
+
+A heatmap file is a sequence of records, each one a '<4sII' header ('HMAP',
+frame number, memory size) followed by four arrays of little endian uint32
+counters (see KINDS), each `size` long. Counters saturate at 2**32 - 1 in the
+file.
+"""
+
+import math
+import struct
+import sys
+from array import array
+
+from annyong.util.compat import array_frombytes, array_tobytes
+from annyong.util.png import RGB, write_png
+
+# Accesses that go straight to the array, and the ones handled by a
+# subscriber (i.e. I/O registers, mirrors and mapper registers).
+KINDS = ('reads', 'writes', 'io_reads', 'io_writes')
+
+_HEADER = struct.Struct('<4sII')
+_MAGIC = b'HMAP'
+
+class HeatmapException(BaseException):
+    pass
+
+class Heatmap(object):
+    """
+    Counts every read and write of a Memory, by address.
+
+    Like annyong.mpu.profiler.Profiler, attaching replaces get_byte() and
+    set_byte() on the memory instance only, so nothing is counted (or paid)
+    until then; detach in the reverse order of attaching. As a frame sink it
+    writes a record per drawn frame to `file` and starts over; otherwise call
+    write() when done.
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self.memory = None
+        self.counters = None
+        self._saved = None
+
+    def attach(self, memory):
+        assert self.memory is None
+        self.memory = memory
+        size = len(memory._read_subscribers)
+        self.counters = dict((kind, array('L', [0] * size)) for kind in KINDS)
+
+        reads, writes = self.counters['reads'], self.counters['writes']
+        io_reads = self.counters['io_reads']
+        io_writes = self.counters['io_writes']
+        get_byte, set_byte = memory.get_byte, memory.set_byte
+
+        # The subscriber lists are looked up on every access, since
+        # Memory.reset() (e.g. loading a ROM) replaces them.
+        def counting_get_byte(offset):
+            if memory._read_subscribers[offset] is not None:
+                io_reads[offset] += 1
+            else:
+                reads[offset] += 1
+            return get_byte(offset)
+
+        def counting_set_byte(offset, value):
+            if memory._write_subscribers[offset]:
+                io_writes[offset] += 1
+            else:
+                writes[offset] += 1
+            return set_byte(offset, value)
+
+        # Whatever was on the instance before (e.g. a profiler) is put back by
+        # detach().
+        self._saved = []
+        for name, wrapper in (('get_byte', counting_get_byte),
+                              ('set_byte', counting_set_byte)):
+            self._saved.append((name, memory.__dict__.get(name), wrapper))
+            setattr(memory, name, wrapper)
+
+    def detach(self):
+        assert self.memory is not None
+        # Anything attached after the heatmap wraps its methods, and would be
+        # lost (or keep calling them) if they were taken out under it.
+        for name, _, wrapper in self._saved:
+            if self.memory.__dict__.get(name) is not wrapper:
+                raise HeatmapException('%s was replaced after the heatmap '
+                                       'was attached; detach that first' %
+                                       name)
+        for name, saved, _ in self._saved:
+            if saved is None:
+                delattr(self.memory, name)
+            else:
+                setattr(self.memory, name, saved)
+        self.memory = None
+
+    def reset(self):
+        for counts in self.counters.values():
+            counts[:] = array('L', [0] * len(counts))
+
+    def __call__(self, nes):
+        self.write(self.file, nes.frame_num)
+        self.reset()
+
+    def write(self, file, frame_num=0):
+        size = len(self.counters['reads'])
+        file.write(_HEADER.pack(_MAGIC, frame_num, size))
+        for kind in KINDS:
+            out = array('I', [min(c, 0xFFFFFFFF)
+                              for c in self.counters[kind]])
+            if sys.byteorder == 'big':
+                out.byteswap()
+            file.write(array_tobytes(out))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+def read_heatmaps(file):
+    # Yields (frame number, {kind: array('I')}) for every record in file.
+    while True:
+        header = file.read(_HEADER.size)
+        if not header:
+            break
+        if len(header) != _HEADER.size:
+            raise HeatmapException('truncated header')
+        magic, frame_num, size = _HEADER.unpack(header)
+        if magic != _MAGIC:
+            raise HeatmapException('not a heatmap record')
+
+        counters = {}
+        for kind in KINDS:
+            counts = array('I')
+            data = file.read(counts.itemsize * size)
+            if len(data) != counts.itemsize * size:
+                raise HeatmapException('truncated record')
+            array_frombytes(counts, data)
+            if sys.byteorder == 'big':
+                counts.byteswap()
+            counters[kind] = counts
+        yield frame_num, counters
+
+def _scale(counts):
+    # Log scale, so a few hammered registers don't hide everything else.
+    top = math.log1p(max(counts) or 1)
+    return [int(255 * math.log1p(c) / top) for c in counts]
+
+def render_heatmap(counters):
+    # A 256x256 RGB image of the 64K address space, one page per row: writes
+    # in red, reads in green and subscriber handled accesses (both ways) in
+    # blue.
+    assert len(counters['reads']) == 0x10000
+    io = [r + w for r, w in zip(counters['io_reads'], counters['io_writes'])]
+    red = _scale(counters['writes'])
+    green = _scale(counters['reads'])
+    blue = _scale(io)
+
+    pixels = bytearray(0x10000 * 3)
+    pixels[0::3] = bytearray(red)
+    pixels[1::3] = bytearray(green)
+    pixels[2::3] = bytearray(blue)
+    return pixels
+
+def write_heatmap_png(path, counters):
+    write_png(path, 256, 256, render_heatmap(counters), RGB)
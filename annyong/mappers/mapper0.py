@@ -1,3 +1,5 @@
+from annyong.util.compat import xrange
+
 class Mapper0(object):
     def __init__(self, nes):
         self.nes = nes
@@ -66,10 +68,14 @@ class Mapper0(object):
         mpu.memory.subscribe_to_write(0x2007, 0x2008, ppu.reg_vram_data)
         mpu.memory.subscribe_to_write(0x4014, 0x4015, ppu.reg_oam_transfer)
 
+        # Joypads
+        mpu.memory.subscribe_to_read( 0x4016, 0x4018, self.nes.reg_joypad)
+        mpu.memory.subscribe_to_write(0x4016, 0x4017,
+                                      self.nes.reg_joypad_strobe)
+
         #### SETUP PPU MEMORY ####
         # Load CHR ROM into ppu memory
-        for i, raw in enumerate(rom.chr_banks):
-            ppu.ptables[i].copy_from_raw(raw)
+        ppu.load_chr(rom.chr_banks[0] if rom.chr_banks else b'')
 
         # Set up mirroring of name tables
         ppu.set_mirroring(rom.mirroring)
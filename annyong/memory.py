@@ -1,5 +1,12 @@
 from array import array
 
+from annyong.util.compat import xrange
+
+def _as_array(data):
+    if isinstance(data, array):
+        return data
+    return array('B', bytearray(data))
+
 class Memory(object):
     def __init__(self, size):
         self._size = size
@@ -9,7 +16,7 @@ class Memory(object):
         self.reset()
 
     def reset(self):
-        self._array = array('B', [0] * self._size)
+        self._array = array('B', b'\0' * self._size)
         self._read_subscribers = [None] * self._size
         self._write_subscribers = [None] * self._size
 
@@ -30,6 +37,43 @@ class Memory(object):
         self.set_byte(offset, value & 0xFF)
         self.set_byte(offset + 1, value >> 8)
 
+    def peek(self, offset):
+        # Reads and writes that bypass the subscribers.
+        return self._array[offset]
+
+    def poke(self, offset, value):
+        self._array[offset] = value
+
+    def read_block(self, start, length):
+        # get_byte() of start up to start + length, as an array. A range
+        # without read subscribers is a single slice; otherwise every byte
+        # goes through get_byte().
+        end = start + length
+        if self._read_subscribers[start:end].count(None) == length:
+            return self._array[start:end]
+        return array('B', [self.get_byte(offset)
+                           for offset in xrange(start, end)])
+
+    def write_block(self, start, data):
+        # set_byte() of data (an array('B') or anything bytearray() takes)
+        # from start on, a single slice assignment when no write subscriber
+        # is in the way.
+        data = _as_array(data)
+        end = start + len(data)
+        if self._write_subscribers[start:end].count(None) == len(data):
+            self._array[start:end] = data
+            return
+        for offset, value in zip(xrange(start, end), data):
+            self.set_byte(offset, value)
+
+    def peek_block(self, start, length):
+        # Like peek() and poke(), a block at a time.
+        return self._array[start:start + length]
+
+    def poke_block(self, start, data):
+        data = _as_array(data)
+        self._array[start:start + len(data)] = data
+
     def subscribe_to_read(self, start, end, fn):
         for i in xrange(start, end):
             assert self._read_subscribers[i] is None
@@ -40,8 +84,26 @@ class Memory(object):
             assert self._write_subscribers[i] is None
             self._write_subscribers[i] = fn
 
+    def replace_read_subscriber(self, offset, fn):
+        # Installs fn (or None) as the only subscriber of offset, returning
+        # the one it replaced.
+        old = self._read_subscribers[offset]
+        self._read_subscribers[offset] = fn
+        return old
+
+    def replace_write_subscriber(self, offset, fn):
+        old = self._write_subscribers[offset]
+        self._write_subscribers[offset] = fn
+        return old
+
+    def snapshot(self):
+        # Subscribers aren't part of the state; they're set up by the mapper.
+        return self._array[:]
+
+    def restore(self, state):
+        self._array[:] = state
+
     def copy_from_raw(self, raw, start, size=None):
         size = size or len(raw)
         assert len(raw) >= size
-        for rpos, mpos in enumerate(xrange(start, start + size)):
-            self._array[mpos] = ord(raw[rpos])
+        self.poke_block(start, raw[:size])
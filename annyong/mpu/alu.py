@@ -0,0 +1,61 @@
+from array import array
+
+from annyong.util.compat import xrange
+
+# Precomputed results and flags for the arithmetic, compare and shift
+# instructions, so the op_* handlers become a table lookup and one update of
+# the status register.
+#
+# Flags are stored as the bits they have in the status register:
+CARRY = 1 << 0
+ZERO = 1 << 1
+OVERFLOW = 1 << 6
+NEGATIVE = 1 << 7
+
+NZ = NEGATIVE | ZERO
+NZC = NEGATIVE | ZERO | CARRY
+NVZ = NEGATIVE | OVERFLOW | ZERO
+NVZC = NEGATIVE | OVERFLOW | ZERO | CARRY
+
+# Tables with both a result and flags hold the result in the low byte and the
+# flags in the high byte.
+
+def _nz(value):
+    return (ZERO if value == 0 else 0) | (value & NEGATIVE)
+
+def _adc(a, value, carry):
+    total = a + value + carry
+    result = total & 0xFF
+    flags = _nz(result) | (total >> 8)
+    if (a ^ result) & (value ^ result) & 0x80:
+        flags |= OVERFLOW
+    return (flags << 8) | result
+
+def _cmp(reg, value):
+    return _nz((reg - value) & 0xFF) | (CARRY if reg >= value else 0)
+
+def _shift(result, carry):
+    return ((_nz(result) | carry) << 8) | result
+
+# Indexed by value
+NZ_FLAGS = array('B', [_nz(v) for v in xrange(256)])
+
+# Indexed by value; the branch offsets.
+SIGNED = tuple(v - 256 if v & 0x80 else v for v in xrange(256))
+
+# Indexed by (carry << 16) | (accumulator << 8) | value. SBC is ADC with the
+# value inverted.
+ADC = array('H', [_adc(a, v, c) for c in (0, 1)
+                                for a in xrange(256)
+                                for v in xrange(256)])
+
+# Indexed by (register << 8) | value; flags only.
+CMP = array('B', [_cmp(r, v) for r in xrange(256) for v in xrange(256)])
+
+# ASL/LSR are indexed by value, ROL/ROR by (carry << 8) | value.
+ASL = array('H', [_shift((v << 1) & 0xFF, v >> 7) for v in xrange(256)])
+LSR = array('H', [_shift(v >> 1, v & 1) for v in xrange(256)])
+ROL = array('H', [_shift(((v << 1) & 0xFF) | c, v >> 7)
+                  for c in (0, 1) for v in xrange(256)])
+ROR = array('H', [_shift((v >> 1) | (c << 7), v & 1)
+                  for c in (0, 1) for v in xrange(256)])
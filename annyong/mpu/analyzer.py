@@ -0,0 +1,325 @@
+import base64
+import hashlib
+import json
+import os
+import zlib
+
+from annyong.mpu.alu import SIGNED
+from annyong.mpu.mpu6502 import opcode_declarations
+from annyong.util.compat import xrange
+
+# Values in BankAnalysis.code_map
+DATA = 0
+OPCODE = 1
+OPERAND = 2
+
+# Where the 6502 finds the entry points, as (name, vector address)
+VECTORS = (('nmi', 0xFFFA), ('reset', 0xFFFC), ('irq', 0xFFFE))
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'annyong',
+                         'analysis')
+
+def _build_decode_table():
+    # opcode -> (handler name, addressing mode, instruction size, invalid),
+    # or None for opcodes the mpu doesn't know (i.e. KIL).
+    table = [None] * 256
+    for opcode, fn, addrmode, _ in opcode_declarations():
+        table[opcode] = (fn.__name__, addrmode.mnemonic,
+                         1 + addrmode.num_operands,
+                         getattr(fn, 'invalid_opcode', False))
+    return table
+
+_decode_table = _build_decode_table()
+
+def prg_layout(rom):
+    # [(bank index, cpu address)] for how the mapper lays out PRG ROM at
+    # power on. Mapper0 is the only mapper so far: two banks at $8000 and
+    # $C000, or the same one twice.
+    last = len(rom.prg_banks) - 1
+    return [(0, 0x8000), (min(last, 1), 0xC000)]
+
+class BankAnalysis(object):
+    def __init__(self, index, windows):
+        self.index = index
+        # The cpu addresses the bank is mapped at.
+        self.windows = windows
+        # DATA, OPCODE or OPERAND for every byte of the bank
+        self.code_map = bytearray(0x4000)
+        # [(entry, last byte)], in cpu addresses
+        self.subroutines = []
+        # target -> [(source, kind)], kind being 'jsr', 'jmp', 'branch' or
+        # 'vector' (where source is the vector's address)
+        self.jump_targets = {}
+
+    def is_code(self, address):
+        return self.code_map[address & 0x3FFF] != DATA
+
+    def code_bytes(self):
+        return len(self.code_map) - self.code_map.count(bytearray([DATA]))
+
+    def to_json(self):
+        return {
+            'index': self.index,
+            'windows': self.windows,
+            'code_map': base64.b64encode(
+                zlib.compress(bytes(self.code_map))).decode('ascii'),
+            'subroutines': self.subroutines,
+            'jump_targets': sorted(self.jump_targets.items()),
+        }
+
+    @staticmethod
+    def from_json(obj):
+        bank = BankAnalysis(obj['index'], obj['windows'])
+        bank.code_map = bytearray(zlib.decompress(
+            base64.b64decode(obj['code_map'])))
+        bank.subroutines = [tuple(s) for s in obj['subroutines']]
+        bank.jump_targets = dict(
+            (target, [tuple(source) for source in sources])
+            for target, sources in obj['jump_targets'])
+        return bank
+
+class RomAnalysis(object):
+    # Bumped whenever the analysis changes, to invalidate the cache.
+    VERSION = 1
+
+    def __init__(self, digest, entry_points, banks, conflicts):
+        self.digest = digest
+        # name -> cpu address, for the vectors
+        self.entry_points = entry_points
+        self.banks = banks
+        # Addresses where decoding ran into the middle of an instruction.
+        self.conflicts = conflicts
+        self._labels = None
+
+    @property
+    def labels(self):
+        # cpu address -> name, for every entry point, subroutine and jump
+        # target.
+        if self._labels is None:
+            labels = {}
+            for bank in self.banks:
+                for target in bank.jump_targets:
+                    labels[target] = 'L_%04X' % target
+                for entry, _ in bank.subroutines:
+                    labels[entry] = 'sub_%04X' % entry
+            for name, address in self.entry_points.items():
+                labels[address] = name
+            self._labels = labels
+        return self._labels
+
+    def summary(self):
+        lines = []
+        for name, address in sorted(self.entry_points.items(),
+                                    key=lambda item: item[1]):
+            lines.append('%-5s $%04X' % (name, address))
+        for bank in self.banks:
+            lines.append('bank %d at %s: %d code bytes, %d subroutines, '
+                         '%d jump targets' % (
+                bank.index,
+                ', '.join('$%04X' % w for w in bank.windows),
+                bank.code_bytes(),
+                len(bank.subroutines),
+                len(bank.jump_targets),
+            ))
+            for entry, end in bank.subroutines:
+                lines.append('    $%04X-$%04X %s' % (entry, end,
+                                                    self.labels[entry]))
+        if self.conflicts:
+            lines.append('overlapping instructions at %s' % ', '.join(
+                '$%04X' % c for c in self.conflicts))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return {
+            'version': RomAnalysis.VERSION,
+            'digest': self.digest,
+            'entry_points': self.entry_points,
+            'banks': [bank.to_json() for bank in self.banks],
+            'conflicts': self.conflicts,
+        }
+
+    @staticmethod
+    def from_json(obj):
+        return RomAnalysis(
+            obj['digest'],
+            dict((str(name), address)
+                 for name, address in obj['entry_points'].items()),
+            [BankAnalysis.from_json(bank) for bank in obj['banks']],
+            obj['conflicts'],
+        )
+
+class Analyzer(object):
+    """
+    Recursive descent disassembly of the PRG ROM as the mpu sees it.
+
+    Starts at the reset, NMI and IRQ vectors and follows JSR, JMP and both
+    ways of every branch. Flow stops at RTS, RTI, BRK, indirect JMPs (their
+    target isn't known statically), opcodes the mpu doesn't know and, unless
+    `allow_invalid` is set, undocumented opcodes; those are much more likely
+    to be data than code.
+    """
+
+    def __init__(self, rom, allow_invalid=False):
+        self.rom = rom
+        self.allow_invalid = allow_invalid
+        self.layout = prg_layout(rom)
+
+        # The $8000-$FFFF window
+        self.image = bytearray()
+        for index, _ in self.layout:
+            self.image += rom.prg_banks[index]
+
+    def byte(self, address):
+        return self.image[address - 0x8000]
+
+    def word(self, address):
+        return self.byte(address) | (self.byte(address + 1) << 8)
+
+    def decode(self, address):
+        # Returns (size, handler name, addressing mode, operand) for the
+        # instruction at address, or None if it doesn't look like code.
+        entry = _decode_table[self.byte(address)]
+        if entry is None:
+            return None
+        name, addrmode, size, invalid = entry
+        if (invalid and not self.allow_invalid) or address + size > 0x10000:
+            return None
+        if size == 1:
+            operand = None
+        elif size == 2:
+            operand = self.byte(address + 1)
+        else:
+            operand = self.word(address + 1)
+        return size, name, addrmode, operand
+
+    def analyze(self):
+        # cpu address -> (size, [successors in the same subroutine])
+        instructions = {}
+        code_map = bytearray(0x8000)
+        jump_targets = {}
+        subroutines = set()
+        conflicts = set()
+
+        def add_target(target, source, kind):
+            if target >= 0x8000:
+                jump_targets.setdefault(target, []).append((source, kind))
+                pending.append(target)
+                return True
+            return False
+
+        pending = []
+        entry_points = {}
+        for name, vector in VECTORS:
+            target = self.word(vector)
+            entry_points[name] = target
+            if add_target(target, vector, 'vector'):
+                subroutines.add(target)
+
+        while pending:
+            address = pending.pop()
+            while address < 0x10000 and address not in instructions:
+                if code_map[address - 0x8000] == OPERAND:
+                    conflicts.add(address)
+                    break
+                decoded = self.decode(address)
+                if decoded is None:
+                    break
+                size, name, addrmode, operand = decoded
+                for i in xrange(size):
+                    offset = address - 0x8000 + i
+                    if code_map[offset] == OPCODE:
+                        conflicts.add(address + i)
+                    code_map[offset] = OPERAND if i else OPCODE
+
+                next_address = address + size
+                successors = [next_address]
+                if name == 'op_branch':
+                    target = (next_address + SIGNED[operand]) & 0xFFFF
+                    if add_target(target, address, 'branch'):
+                        successors.append(target)
+                elif name == 'op_jsr':
+                    if add_target(operand, address, 'jsr'):
+                        subroutines.add(operand)
+                elif name == 'op_jmp':
+                    successors = []
+                    if addrmode == 'abs' and add_target(operand, address,
+                                                        'jmp'):
+                        successors.append(operand)
+                elif name in ('op_rts', 'op_rti', 'op_brk'):
+                    successors = []
+
+                instructions[address] = (size, successors)
+                if not successors or successors[0] != next_address:
+                    break
+                address = next_address
+
+        extents = [self._extent(entry, instructions, subroutines)
+                   for entry in sorted(subroutines)]
+
+        banks = []
+        for index, window in self.layout:
+            bank = None
+            for other in banks:
+                if other.index == index:
+                    bank = other
+                    bank.windows.append(window)
+            if bank is None:
+                bank = BankAnalysis(index, [window])
+                banks.append(bank)
+
+            start = window - 0x8000
+            for offset, kind in enumerate(code_map[start:start + 0x4000]):
+                if kind != DATA and bank.code_map[offset] == DATA:
+                    bank.code_map[offset] = kind
+            for entry, end in extents:
+                if window <= entry < window + 0x4000:
+                    bank.subroutines.append((entry, end))
+            for target, sources in jump_targets.items():
+                if window <= target < window + 0x4000:
+                    bank.jump_targets[target] = sorted(sources)
+
+        return RomAnalysis(hashlib.sha1(self.rom.raw).hexdigest(),
+                           entry_points, banks, sorted(conflicts))
+
+    def _extent(self, entry, instructions, subroutines):
+        # (entry, last byte) of what's reachable from entry without going
+        # into another subroutine (i.e. a JMP to one is a tail call).
+        end = entry
+        seen = set([entry])
+        pending = [entry]
+        while pending:
+            address = pending.pop()
+            if address not in instructions:
+                continue
+            size, successors = instructions[address]
+            end = max(end, address + size - 1)
+            for successor in successors:
+                if successor not in seen and successor not in subroutines:
+                    seen.add(successor)
+                    pending.append(successor)
+        return entry, end
+
+def analyze_rom(rom, cache_dir=CACHE_DIR):
+    # Analyzes rom, or loads the analysis from cache_dir, keyed by the hash of
+    # the ROM file. A cache_dir of None disables the cache.
+    digest = hashlib.sha1(rom.raw).hexdigest()
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, '%s.v%d.json' % (digest,
+                                                        RomAnalysis.VERSION))
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                return RomAnalysis.from_json(json.load(file))
+
+    analysis = Analyzer(rom).analyze()
+
+    if path:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Written to a temporary file first, so other processes never see a
+        # half written cache entry.
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as file:
+            json.dump(analysis.to_json(), file)
+        os.rename(tmp_path, path)
+    return analysis
@@ -0,0 +1,226 @@
+import hashlib
+import re
+
+from annyong.mpu.debug import BRANCH_MNEMONICS, mnemonic
+from annyong.mpu.mpu6502 import opcode_declarations
+
+class AssemblerException(BaseException):
+    def __init__(self, line_no, line, msg):
+        self.line_no = line_no
+        self.line = line
+        self.msg = msg
+
+    def __str__(self):
+        return 'line %d: %s (%r)' % (self.line_no, self.msg, self.line)
+
+def _build_opcode_table():
+    # (mnemonic, addressing mode) -> opcode, from the same defopcode()
+    # declarations Mpu6502._opcodes is built from. Invalid opcodes are left
+    # out, so e.g. NOP always assembles to 0xEA.
+    table = {}
+    for opcode, fn, addrmode, _ in opcode_declarations():
+        if not getattr(fn, 'invalid_opcode', False):
+            table[(mnemonic(fn, opcode), addrmode.mnemonic)] = opcode
+    return table
+
+_opcode_table = _build_opcode_table()
+_mnemonics = set(mnemonic for mnemonic, _ in _opcode_table)
+_branch_mnemonics = set(BRANCH_MNEMONICS.values())
+
+# Operand syntax -> (addressing mode, or the zero page one first when the
+# value fits in a byte)
+_operand_formats = (
+    (re.compile(r'^#(.+)$'), ('imm',)),
+    (re.compile(r'^\((.+),\s*[xX]\)$'), ('zp ind x',)),
+    (re.compile(r'^\((.+)\),\s*[yY]$'), ('zp ind y',)),
+    (re.compile(r'^\((.+)\)$'), ('abs ind',)),
+    (re.compile(r'^(.+),\s*[xX]$'), ('zp x', 'abs x')),
+    (re.compile(r'^(.+),\s*[yY]$'), ('zp y', 'abs y')),
+    (re.compile(r'^(.+)$'), ('zp', 'abs')),
+)
+_operand_sizes = {
+    'impl': 0, 'acc': 0, 'imm': 1, 'zp': 1, 'zp x': 1, 'zp y': 1,
+    'zp ind x': 1, 'zp ind y': 1, 'abs': 2, 'abs x': 2, 'abs y': 2,
+    'abs ind': 2,
+}
+_label_re = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*):')
+_term_re = re.compile(r'\s*([-+])?\s*([<>]?)(\$[0-9A-Fa-f]+|%[01]+|[0-9]+|'
+                      r'[A-Za-z_][A-Za-z0-9_]*)\s*')
+
+class Assembler(object):
+    """
+    A small two-pass 6502 assembler for the snippets in tests/mpu/*.t.
+
+    Understands what the xa invocation it replaces was used for: labels,
+    `.byte`/`.word`, `;` comments and the usual operand syntax, with `$hex`,
+    `%binary`, decimal, labels, `<`/`>` (low/high byte) and `+`/`-` in
+    expressions. Code is assembled from address `org` (default 0). Forward
+    references are assumed to be absolute, like xa does.
+    """
+
+    def __init__(self, org=0):
+        self.org = org
+        self._cache = {}
+
+    def assemble(self, source):
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        if key not in self._cache:
+            self._cache[key] = self._assemble(source)
+        return self._cache[key]
+
+    def _assemble(self, source):
+        statements = self._parse(source)
+
+        # Pass 1: find the size of every statement to place the labels.
+        labels = {}
+        sizes = []
+        pc = self.org
+        for line_no, line, label, op, operand in statements:
+            if label:
+                if label in labels:
+                    raise AssemblerException(line_no, line,
+                                             'label defined twice')
+                labels[label] = pc
+            size = self._emit(line_no, line, op, operand, labels, pc,
+                              None)
+            sizes.append(size)
+            pc += size
+
+        # Pass 2: emit the code.
+        out = bytearray()
+        pc = self.org
+        for (line_no, line, label, op, operand), size in zip(statements,
+                                                              sizes):
+            self._emit(line_no, line, op, operand, labels, pc, out, size)
+            pc += size
+        return bytes(out)
+
+    def _parse(self, source):
+        statements = []
+        for line_no, line in enumerate(source.split('\n'), 1):
+            text = line.split(';', 1)[0].strip()
+            label = None
+            match = _label_re.match(text)
+            if match:
+                label = match.group(1)
+                text = text[match.end():].strip()
+            if not text and not label:
+                continue
+            op, _, operand = text.partition(' ')
+            statements.append((line_no, line, label, op, operand.strip()))
+        return statements
+
+    def _eval(self, line_no, line, expr, labels):
+        # Returns None for labels that aren't defined (yet).
+        value = 0
+        pos = 0
+        while pos < len(expr):
+            match = _term_re.match(expr, pos)
+            if not match or (pos and not match.group(1)):
+                raise AssemblerException(line_no, line, 'invalid expression')
+            sign, byte, term = match.groups()
+            pos = match.end()
+
+            if term.startswith('$'):
+                term = int(term[1:], 16)
+            elif term.startswith('%'):
+                term = int(term[1:], 2)
+            elif term.isdigit():
+                term = int(term, 10)
+            elif term in labels:
+                term = labels[term]
+            else:
+                return None
+
+            if byte == '<':
+                term &= 0xFF
+            elif byte == '>':
+                term = (term >> 8) & 0xFF
+            value = value - term if sign == '-' else value + term
+        return value
+
+    def _emit(self, line_no, line, op, operand, labels, pc, out, size=None):
+        # Returns the size of the statement, and appends its bytes to out
+        # unless it's None (i.e. in the first pass).
+        def error(msg):
+            raise AssemblerException(line_no, line, msg)
+
+        def value_of(expr, resolve):
+            value = self._eval(line_no, line, expr, labels)
+            if value is None and resolve:
+                error('undefined label')
+            return value
+
+        if not op:
+            return 0
+
+        if op.lower() in ('.byte', '.word'):
+            width = 1 if op.lower() == '.byte' else 2
+            exprs = [e.strip() for e in operand.split(',')]
+            if out is not None:
+                for expr in exprs:
+                    value = value_of(expr, True)
+                    if not 0 <= value < (1 << (8 * width)):
+                        error('value out of range')
+                    out.append(value & 0xFF)
+                    if width == 2:
+                        out.append(value >> 8)
+            return width * len(exprs)
+
+        op = op.upper()
+        if op not in _mnemonics:
+            error('unknown instruction')
+
+        if not operand or operand.upper() == 'A':
+            addrmode = 'acc' if (op, 'acc') in _opcode_table else 'impl'
+            if (op, addrmode) not in _opcode_table:
+                error('missing operand')
+            if out is not None:
+                out.append(_opcode_table[(op, addrmode)])
+            return 1
+
+        for regex, addrmodes in _operand_formats:
+            match = regex.match(operand)
+            if match:
+                expr = match.group(1).strip()
+                break
+
+        value = value_of(expr, out is not None)
+        is_branch = op in _branch_mnemonics
+        if is_branch:
+            addrmode = 'imm'
+        elif len(addrmodes) == 2:
+            # The zero page mode when the value is known to fit in a byte; in
+            # the second pass the size decided in the first pass wins.
+            zp_fits = value is not None and value < 0x100
+            if size is not None:
+                zp_fits = size == 2
+            addrmode = addrmodes[0]
+            if not zp_fits or (op, addrmode) not in _opcode_table:
+                addrmode = addrmodes[1]
+        else:
+            addrmode = addrmodes[0]
+
+        if (op, addrmode) not in _opcode_table:
+            error('invalid addressing mode')
+        num_operands = _operand_sizes[addrmode]
+
+        if out is not None:
+            if is_branch:
+                value -= pc + 2
+                if not -128 <= value <= 127:
+                    error('branch out of range')
+                value &= 0xFF
+            elif not 0 <= value < (1 << (8 * num_operands)):
+                error('value out of range')
+            out.append(_opcode_table[(op, addrmode)])
+            out.append(value & 0xFF)
+            if num_operands == 2:
+                out.append(value >> 8)
+        return 1 + num_operands
+
+_assembler = Assembler()
+
+def assemble(source):
+    # Assembles at address 0, with results cached by a hash of the source.
+    return _assembler.assemble(source)
@@ -1,20 +1,22 @@
 import struct
 
+# To have better code, these opcodes were writting as one method in the mpu,
+# so we can't infer their mnemonics by looking at the method name.
+BRANCH_MNEMONICS = {
+    0x90: 'BCC', 0xB0: 'BCS', 0xD0: 'BNE', 0xF0: 'BEQ',
+    0x10: 'BPL', 0x30: 'BMI', 0x50: 'BVC', 0x70: 'BVS',
+}
+
+def mnemonic(fn, opcode):
+    if opcode in BRANCH_MNEMONICS:
+        return BRANCH_MNEMONICS[opcode]
+    # This will also make NOP2 into NOP.
+    return fn.__name__[3:6].upper()
+
 def disassemble(mpu, opcode, operands, nestest_trace):
     fn, addrmode, _ = mpu._opcodes[opcode]
 
-    # To have better code, these opcodes were writting as one method in the mpu,
-    # so we can't infer their mnemonics by looking at the method name.
-    branch_opcodes = {
-        0x90: 'BCC', 0xB0: 'BCS', 0xD0: 'BNE', 0xF0: 'BEQ',
-        0x10: 'BPL', 0x30: 'BMI', 0x50: 'BVC', 0x70: 'BVS',
-    }
-
-    if opcode in branch_opcodes:
-        asm = branch_opcodes[opcode]
-    else:
-        # This will also make NOP2 into NOP.
-        asm = fn.__name__[3:6].upper()
+    asm = mnemonic(fn, opcode)
 
     if nestest_trace:
         return asm
@@ -35,8 +37,8 @@ def disassemble(mpu, opcode, operands, nestest_trace):
     }
 
     if operands:
-        bytes = ''.join(chr(o) for o in operands)
-        operands = struct.unpack('H' if len(bytes) > 1 else 'B', bytes)[0]
+        operands = struct.unpack('<H' if len(operands) > 1 else 'B',
+                                 bytes(bytearray(operands)))[0]
 
     asm += ' %s' % (addrmode_fmts[addrmode.mnemonic] % operands)
     return asm.strip().ljust(11)
@@ -0,0 +1,67 @@
+from array import array
+
+from annyong.mpu.alu import CARRY, NEGATIVE, OVERFLOW, ZERO
+from annyong.util.compat import xrange
+
+# Decimal mode ADC/SBC as it behaves on an NMOS 6502 (the 2A03 has no decimal
+# mode). Every table is indexed by (accumulator << 8) | operand, and there's
+# one table per incoming carry. Like the annyong.mpu.alu tables, an entry
+# holds the new accumulator in the low byte and the flags in the high byte.
+
+_tables = None
+
+def _adc(a, b, carry):
+    # N and V come from the sum before the high nibble is adjusted, and Z from
+    # the binary sum.
+    low = (a & 0x0F) + (b & 0x0F) + carry
+    if low >= 0x0A:
+        low = ((low + 0x06) & 0x0F) + 0x10
+    result = (a & 0xF0) + (b & 0xF0) + low
+
+    flags = 0
+    if result & 0x80:
+        flags |= NEGATIVE
+    if (a ^ result) & (b ^ result) & 0x80:
+        flags |= OVERFLOW
+    if (a + b + carry) & 0xFF == 0:
+        flags |= ZERO
+
+    if result >= 0xA0:
+        result += 0x60
+    if result >= 0x100:
+        flags |= CARRY
+    return (flags << 8) | (result & 0xFF)
+
+def _sbc(a, b, carry):
+    # All flags are the same as in binary mode; only the result is adjusted.
+    low = (a & 0x0F) - (b & 0x0F) + carry - 1
+    if low < 0:
+        low = ((low - 0x06) & 0x0F) - 0x10
+    result = (a & 0xF0) - (b & 0xF0) + low
+    if result < 0:
+        result -= 0x60
+
+    binary = a - b - (1 - carry)
+    flags = 0
+    if binary >= 0:
+        flags |= CARRY
+    if binary & 0xFF == 0:
+        flags |= ZERO
+    if binary & 0x80:
+        flags |= NEGATIVE
+    if (a ^ b) & (a ^ binary) & 0x80:
+        flags |= OVERFLOW
+    return (flags << 8) | (result & 0xFF)
+
+def decimal_tables():
+    # Returns (adc tables, sbc tables), each indexed by carry. They're built
+    # the first time they're needed, and then shared by every mpu.
+    global _tables
+    if _tables is None:
+        _tables = tuple(
+            tuple(array('H', [fn(a, b, carry) for a in xrange(256)
+                                              for b in xrange(256)])
+                  for carry in (0, 1))
+            for fn in (_adc, _sbc)
+        )
+    return _tables
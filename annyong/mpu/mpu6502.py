@@ -1,9 +1,20 @@
-from inspect import getargspec
-
 from annyong.util.bitset import Bitset
+from annyong.util.compat import xrange
 from annyong.mpu.debug import disassemble
+from annyong.mpu import alu, decimal
 from annyong.memory import Memory
-from annyong.util import signed_byte
+
+# How execute_opcode() calls a handler, picked by its argument names when the
+# opcode table is built.
+(_CALL_NONE, _CALL_VALUE, _CALL_OFFSET, _CALL_OFFSET_VALUE,
+ _CALL_BRANCH) = range(5)
+_CALLS = {
+    (): _CALL_NONE,
+    ('value',): _CALL_VALUE,
+    ('offset',): _CALL_OFFSET,
+    ('offset', 'value'): _CALL_OFFSET_VALUE,
+    ('value', 'opcode'): _CALL_BRANCH,
+}
 
 # decorators {{{
 
@@ -62,17 +73,24 @@ class Mpu6502(object):
                 ('negative', 1),
             )
 
-    def __init__(self, nes):
+    # The NES' 2A03 ignores the decimal flag; a plain NMOS 6502 doesn't.
+    VARIANT_2A03 = '2A03'
+    VARIANT_NMOS = 'nmos'
+
+    def __init__(self, nes, variant=VARIANT_2A03):
+        assert variant in (Mpu6502.VARIANT_2A03, Mpu6502.VARIANT_NMOS)
         self.nes = nes
-        self._addrmodes = {}
-        self._opcodes = [None] * 256
+        self.variant = variant
+        self._decimal_adc = None
+        self._decimal_sbc = None
+        if variant == Mpu6502.VARIANT_NMOS:
+            self._decimal_adc, self._decimal_sbc = decimal.decimal_tables()
         self.reg = Mpu6502.Registers()
         self.memory = Memory(0x10000)
         self.cycles = 0
         self.halt_cycles = None
 
-        self._init_addrmodes()
-        self._init_opcodes()
+        Mpu6502._init_opcodes()
         self.reset()
 
     def __str__(self):
@@ -86,24 +104,47 @@ class Mpu6502(object):
         )
     repr = __str__
 
-    def _init_addrmodes(self):
-        for key in dir(self):
-            fn = getattr(self, key)
-            if not hasattr(fn, 'mnemonic'):
-                continue
-            self._addrmodes[fn.mnemonic] = fn
-
-    def _init_opcodes(self):
-        for key in dir(self):
-            fn = getattr(self, key)
-            if not hasattr(fn, 'opcodes'):
-                continue
-            for opcode, mnemonic, cycles in fn.opcodes:
-                self._opcodes[opcode] = (fn, self._addrmodes[mnemonic], cycles)
+    # opcode -> (handler, addressing mode, cycles), None for opcodes that
+    # aren't implemented. The handler and addressing mode are the plain
+    # functions (i.e. called with the mpu), so one table serves every
+    # instance; it's built by the first one.
+    _opcodes = None
+    # opcode -> what execute_opcode() needs, worked out up front so running an
+    # instruction doesn't have to look at the handler.
+    _dispatch = None
+
+    @staticmethod
+    def _init_opcodes():
+        if Mpu6502._opcodes is not None:
+            return
+        opcodes = [None] * 256
+        dispatch = [None] * 256
+        for opcode, fn, addrmode, cycles in opcode_declarations():
+            opcodes[opcode] = (fn, addrmode, cycles)
+
+            code = fn.__code__
+            call = _CALLS[code.co_varnames[1:code.co_argcount]]
+            # These addressing modes give the value itself rather than where
+            # it is.
+            immediate = addrmode.mnemonic in ('impl', 'imm', 'acc')
+            # Memory is only read for handlers that use the value, since a
+            # read can have side effects (e.g. $2002).
+            load = not immediate and call not in (_CALL_NONE, _CALL_OFFSET)
+            dispatch[opcode] = (
+                fn, addrmode, addrmode.num_operands, cycles, call, immediate,
+                load, getattr(fn, 'use_extra_cycles', False),
+            )
+        Mpu6502._opcodes = opcodes
+        Mpu6502._dispatch = dispatch
+
+    def _set_flags(self, mask, flags):
+        # Replaces the status bits in mask with flags (see annyong.mpu.alu).
+        ps = self.reg.ps
+        ps.set((int(ps) & ~mask) | flags)
 
     def _set_nz_flags(self, value):
-        self.reg.ps.zero = 0 == value
-        self.reg.ps.negative = value >> 7
+        ps = self.reg.ps
+        ps.set((int(ps) & ~alu.NZ) | alu.NZ_FLAGS[value])
 
     def reset(self):
         self.reg.x = 0
@@ -116,6 +157,18 @@ class Mpu6502(object):
         self.cycles = 0
         self.halt_cycles = 0
 
+    def snapshot(self):
+        reg = self.reg
+        return (reg.pc, reg.sp, reg.ac, reg.x, reg.y, int(reg.ps),
+                self.cycles, self.halt_cycles, self.memory.snapshot())
+
+    def restore(self, state):
+        reg = self.reg
+        (reg.pc, reg.sp, reg.ac, reg.x, reg.y, ps,
+         self.cycles, self.halt_cycles, memory) = state
+        reg.ps.set(ps)
+        self.memory.restore(memory)
+
     def interrupt(self, type):
         if type == 'reset':
             self.reg.pc = self.memory.get_word(0xFFFC)
@@ -149,47 +202,53 @@ class Mpu6502(object):
 
         prev_cycles = self.cycles
 
-        opcode = self.memory.get_byte(self.reg.pc)
+        # PC moves past the opcode before it's fetched, so a read subscriber
+        # can tell the fetch (offset == pc - 1) from a read of the operand
+        # (offset == pc); see annyong.debugger.
+        pc = self.reg.pc
+        self.reg.pc = (pc + 1) & 0xFFFF
+        opcode = self.memory.get_byte(pc)
         if not self._opcodes[opcode]:
+            self.reg.pc = pc
             raise Mpu6502.InvalidOpcodeException(opcode)
 
         if self.nes.logfile:
+            self.reg.pc = pc
             self.trace(opcode)
+            self.reg.pc = (pc + 1) & 0xFFFF
 
-        self.reg.pc = (self.reg.pc + 1) & 0xFFFF
         self.execute_opcode(opcode)
 
         return self.cycles - prev_cycles
 
     def execute_opcode(self, opcode):
-        fn, addrmode, cycles = self._opcodes[opcode]
-
-        fn_args = getargspec(fn).args
-        kwargs = {}
-        
-        offset = value = None
-        if addrmode.mnemonic in ('impl', 'imm', 'acc'):
-            value, extra_cycles = addrmode()
-        else:
-            offset, extra_cycles = addrmode()
-
-        self.reg.pc += addrmode.num_operands
+        (fn, addrmode, num_operands, cycles, call, immediate, load,
+         use_extra_cycles) = self._dispatch[opcode]
 
-        if 'value' in fn_args and offset is not None:
-            value = self.memory.get_byte(offset)
+        operand, extra_cycles = addrmode(self)
+        self.reg.pc += num_operands
 
-        if 'opcode' in fn_args:
-            kwargs['opcode'] = opcode
-        if 'value' in fn_args:
-            kwargs['value'] = value
-        if 'offset' in fn_args:
-            kwargs['offset'] = offset
+        if immediate:
+            offset, value = None, operand
+        else:
+            offset = operand
+            value = self.memory.get_byte(offset) if load else None
+
+        if call == _CALL_NONE:
+            ret = fn(self)
+        elif call == _CALL_VALUE:
+            ret = fn(self, value)
+        elif call == _CALL_OFFSET:
+            ret = fn(self, offset)
+        elif call == _CALL_OFFSET_VALUE:
+            ret = fn(self, offset, value)
+        else:
+            ret = fn(self, value, opcode)
 
-        ret = fn(**kwargs)
         self.cycles += cycles
         if ret is not None:
             self.cycles += ret
-        if getattr(fn, 'use_extra_cycles', False):
+        if use_extra_cycles:
             self.cycles += extra_cycles
 
         return ret
@@ -368,103 +427,102 @@ class Mpu6502(object):
 
     @defopcode((0x24, 'zp', 3), (0x2C, 'abs', 4))
     def op_bit(self, value):
-        self.reg.ps.zero = 0 == value & self.reg.ac
-        self.reg.ps.negative = value >> 7
-        self.reg.ps.overflow = (value >> 6) & 1
+        zero = alu.NZ_FLAGS[value & self.reg.ac] & alu.ZERO
+        self._set_flags(alu.NVZ, (value & (alu.NEGATIVE | alu.OVERFLOW)) | zero)
 
     @opcode_use_extra_cycles
     @defopcode((0x69, 'imm', 2), (0x65, 'zp', 3), (0x75, 'zp x', 4),
                (0x6D, 'abs', 4), (0x7D, 'abs x', 4), (0x79, 'abs y', 4),
                (0x61, 'zp ind x', 6), (0x71, 'zp ind y', 5))
     def op_adc(self, value):
-        carry = self.reg.ps.carry
+        if self._decimal_adc and self.reg.ps.decimal:
+            table = self._decimal_adc[int(self.reg.ps) & alu.CARRY]
+            self._set_adc_result(table[(self.reg.ac << 8) | value])
+        else:
+            self._adc_binary(value)
 
-        # TODO: Decimal mode removed temporarily.
+    def _adc_binary(self, value):
+        carry = int(self.reg.ps) & alu.CARRY
+        index = (carry << 16) | (self.reg.ac << 8) | value
+        self._set_adc_result(alu.ADC[index])
 
-        result = signed_byte(value) + signed_byte(self.reg.ac) + carry
-        self.reg.ps.overflow = result > 127 or result < -128
-        self.reg.ps.carry = value + self.reg.ac + carry > 255
-        result &= 0xFF
-
-        self.reg.ac = result
-        self._set_nz_flags(self.reg.ac)
+    def _set_adc_result(self, entry):
+        self.reg.ac = entry & 0xFF
+        self._set_flags(alu.NVZC, entry >> 8)
 
     @opcode_use_extra_cycles
     @defopcode((0xE9, 'imm', 2), (0xE5, 'zp', 3), (0xF5, 'zp x', 4),
                (0xED, 'abs', 4), (0xFD, 'abs x', 4), (0xF9, 'abs y', 4),
                (0xE1, 'zp ind x', 6), (0xF1, 'zp ind y', 5))
     def op_sbc(self, value):
-        return self.op_adc(value ^ 0xFF)
+        if self._decimal_sbc and self.reg.ps.decimal:
+            table = self._decimal_sbc[int(self.reg.ps) & alu.CARRY]
+            self._set_adc_result(table[(self.reg.ac << 8) | value])
+        else:
+            self._adc_binary(value ^ 0xFF)
 
     @defopcode((0x0A, 'acc', 2), (0x06, 'zp', 5), (0x16, 'zp x', 6),
                (0x0E, 'abs', 6), (0x1E, 'abs x', 7))
     def op_asl(self, offset, value):
-        self.reg.ps.carry = value >> 7
-        value = (value << 1) & 0xFF
+        entry = alu.ASL[value]
+        self._set_flags(alu.NZC, entry >> 8)
+        value = entry & 0xFF
 
         if offset is None: # 0x0A
             self.reg.ac = value
         else:
             self.memory.set_byte(offset, value)
-        self._set_nz_flags(value)
 
     @defopcode((0x4A, 'acc', 2), (0x46, 'zp', 5), (0x56, 'zp x', 6),
                (0x4E, 'abs', 6), (0x5E, 'abs x', 7))
     def op_lsr(self, offset, value):
-        self.reg.ps.carry = value & 1
-        value >>= 1
+        entry = alu.LSR[value]
+        self._set_flags(alu.NZC, entry >> 8)
+        value = entry & 0xFF
 
         if offset is None: # 0x4A
             self.reg.ac = value
         else:
             self.memory.set_byte(offset, value)
-        self._set_nz_flags(value)
 
     @defopcode((0x2A, 'acc', 2), (0x26, 'zp', 5), (0x36, 'zp x', 6),
                (0x2E, 'abs', 6), (0x3E, 'abs x', 7))
     def op_rol(self, offset, value):
-        carry = self.reg.ps.carry
-        self.reg.ps.carry = value >> 7
-
-        value = ((value << 1) + carry) & 0xFF
+        entry = alu.ROL[((int(self.reg.ps) & alu.CARRY) << 8) | value]
+        self._set_flags(alu.NZC, entry >> 8)
+        value = entry & 0xFF
 
         if offset is None: # 0x2A
             self.reg.ac = value
         else:
             self.memory.set_byte(offset, value)
-        self._set_nz_flags(value)
 
     @defopcode((0x6A, 'acc', 2), (0x66, 'zp', 5), (0x76, 'zp x', 6),
                (0x6E, 'abs', 6), (0x7E, 'abs x', 7))
     def op_ror(self, offset, value):
-        new_carry = value & 1
-
-        value = (value >> 1) | (self.reg.ps.carry << 7)
-        self.reg.ps.carry = new_carry
+        entry = alu.ROR[((int(self.reg.ps) & alu.CARRY) << 8) | value]
+        self._set_flags(alu.NZC, entry >> 8)
+        value = entry & 0xFF
 
         if offset is None: # 0x6A
             self.reg.ac = value
         else:
             self.memory.set_byte(offset, value)
-        self._set_nz_flags(value)
     
     @opcode_use_extra_cycles
     @defopcode((0xC9, 'imm', 2), (0xC5, 'zp', 3), (0xD5, 'zp x', 4),
                (0xCD, 'abs', 4), (0xDD, 'abs x', 4), (0xD9, 'abs y', 4),
                (0xC1, 'zp ind x', 6), (0xD1, 'zp ind y', 5))
     def op_cmp(self, value):
-        self.reg.ps.carry = self.reg.ac >= value
-        self._set_nz_flags((self.reg.ac - value) & 0xFF)
+        self._set_flags(alu.NZC, alu.CMP[(self.reg.ac << 8) | value])
 
     @defopcode((0xE0, 'imm', 2), (0xE4, 'zp', 3), (0xEC, 'abs', 4))
     def op_cpx(self, value):
-        self.reg.ps.carry = self.reg.x >= value
-        self._set_nz_flags((self.reg.x - value) & 0xFF)
+        self._set_flags(alu.NZC, alu.CMP[(self.reg.x << 8) | value])
 
     @defopcode((0xC0, 'imm', 2), (0xC4, 'zp', 3), (0xCC, 'abs', 4))
     def op_cpy(self, value):
-        self.reg.ps.carry = self.reg.y >= value
-        self._set_nz_flags((self.reg.y - value) & 0xFF)
+        self._set_flags(alu.NZC, alu.CMP[(self.reg.y << 8) | value])
 
     @defopcode((0xE6, 'zp', 5), (0xF6, 'zp x', 6), (0xEE, 'abs', 6),
                (0xFE, 'abs x', 7))
@@ -603,23 +661,24 @@ class Mpu6502(object):
     def op_rts(self, value):
         self.reg.pc = (self.pop_word() + 1) & 0xFFFF
 
+    # opcode -> (status flag, whether to branch when it's set)
+    _branch_conditions = {
+        0x90: (alu.CARRY, False),    0xB0: (alu.CARRY, True),
+        0xD0: (alu.ZERO, False),     0xF0: (alu.ZERO, True),
+        0x10: (alu.NEGATIVE, False), 0x30: (alu.NEGATIVE, True),
+        0x50: (alu.OVERFLOW, False), 0x70: (alu.OVERFLOW, True),
+    }
+
     @defopcode((0x90, 'imm', 2), (0xB0, 'imm', 2),
                (0xD0, 'imm', 2), (0xF0, 'imm', 2),
                (0x10, 'imm', 2), (0x30, 'imm', 2),
                (0x50, 'imm', 2), (0x70, 'imm', 2))
     def op_branch(self, value, opcode):
-        flags = {
-            0x90: 'carry',    0xB0: 'carry',
-            0xD0: 'zero',     0xF0: 'zero',
-            0x10: 'negative', 0x30: 'negative',
-            0x50: 'overflow', 0x70: 'overflow',
-        }
-        cond = bool(getattr(self.reg.ps, flags[opcode]))
-        branch_if_true = opcode in (0xB0, 0xF0, 0x30, 0x70)
-
-        if cond == branch_if_true:
+        flag, branch_if_set = Mpu6502._branch_conditions[opcode]
+
+        if (int(self.reg.ps) & flag != 0) == branch_if_set:
             old_pc = self.reg.pc
-            new_pc = (self.reg.pc + signed_byte(value)) & 0xFFFF
+            new_pc = (self.reg.pc + alu.SIGNED[value]) & 0xFFFF
             self.reg.pc = new_pc
             return 2 if (old_pc & 0xFF00) != (new_pc & 0xFF00) else 1
 
@@ -683,8 +742,9 @@ class Mpu6502(object):
                (0x1F, 'abs x', 7), (0x1B, 'abs y', 7), (0x03, 'zp ind x', 8),
                (0x13, 'zp ind y', 8))
     def op_slo(self, offset, value):
-        self.reg.ps.carry = value >> 7
-        value = (value << 1) & 0xFF
+        entry = alu.ASL[value]
+        value = entry & 0xFF
+        self._set_flags(alu.CARRY, (entry >> 8) & alu.CARRY)
         self.op_ora(value)
         self.memory.set_byte(offset, value)
 
@@ -693,9 +753,9 @@ class Mpu6502(object):
                (0x3F, 'abs x', 7), (0x3B, 'abs y', 7), (0x23, 'zp ind x', 8),
                (0x33, 'zp ind y', 8))
     def op_rla(self, offset, value):
-        carry = self.reg.ps.carry
-        self.reg.ps.carry = value >> 7
-        value = ((value << 1) & 0xFF) | carry
+        entry = alu.ROL[((int(self.reg.ps) & alu.CARRY) << 8) | value]
+        value = entry & 0xFF
+        self._set_flags(alu.CARRY, (entry >> 8) & alu.CARRY)
         self.op_and(value)
         self.memory.set_byte(offset, value)
 
@@ -704,10 +764,10 @@ class Mpu6502(object):
                (0x5F, 'abs x', 7), (0x5B, 'abs y', 7), (0x43, 'zp ind x', 8),
                (0x53, 'zp ind y', 8))
     def op_sre(self, offset, value):
-        carry = value & 1
-        value >>= 1
+        entry = alu.LSR[value]
+        value = entry & 0xFF
+        self._set_flags(alu.CARRY, (entry >> 8) & alu.CARRY)
         self.op_eor(value)
-        self.reg.ps.carry = carry
         self.memory.set_byte(offset, value)
 
     @opcode_invalid
@@ -715,9 +775,9 @@ class Mpu6502(object):
                (0x7F, 'abs x', 7), (0x7B, 'abs y', 7), (0x63, 'zp ind x', 8),
                (0x73, 'zp ind y', 8))
     def op_rra(self, offset, value):
-        carry = self.reg.ps.carry
-        self.reg.ps.carry = value & 1
-        value = (value >> 1) | (carry << 7)
+        entry = alu.ROR[((int(self.reg.ps) & alu.CARRY) << 8) | value]
+        value = entry & 0xFF
+        self._set_flags(alu.CARRY, (entry >> 8) & alu.CARRY)
         self.op_adc(value)
         self.memory.set_byte(offset, value)
 
@@ -737,7 +797,7 @@ class Mpu6502(object):
 
         cyc = (self.cycles * 3) % 341
         if nestest_trace:
-            sl = (self.cycles * 3) / 341
+            sl = (self.cycles * 3) // 341
             sl += 241
             while sl >= 261:
                 sl -= 262
@@ -750,6 +810,11 @@ class Mpu6502(object):
                                ('zero', 'z'), ('carry', 'c')):
                 flags += val.upper() if getattr(self.reg.ps, key) else val
 
+            if self.nes.analysis:
+                label = self.nes.analysis.labels.get(self.reg.pc)
+                if label:
+                    self.nes.log('%s:' % label)
+
         if nestest_trace:
             string = (
                 ('%04X  %02X %s %s%s  A:%02X '
@@ -788,3 +853,14 @@ class Mpu6502(object):
         self.nes.log(string)
 
     # }}}
+
+def opcode_declarations():
+    # Yields (opcode, handler, addressing mode, cycles) for every opcode
+    # declared on Mpu6502, without needing an instance. The handler and
+    # addressing mode are the plain (unbound) functions.
+    members = vars(Mpu6502).values()
+    addrmodes = dict((fn.mnemonic, fn) for fn in members
+                     if hasattr(fn, 'mnemonic'))
+    for fn in members:
+        for opcode, mnemonic, cycles in getattr(fn, 'opcodes', ()):
+            yield opcode, fn, addrmodes[mnemonic], cycles
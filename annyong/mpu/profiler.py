@@ -0,0 +1,153 @@
+import json
+from array import array
+from timeit import default_timer
+
+class ProfilerException(BaseException):
+    pass
+
+class Profiler(object):
+    """
+    Counts executed opcodes and bus accesses of an Mpu6502.
+
+    Attaching replaces execute_opcode() and the memory's get_byte()/set_byte()
+    on the instances only, so an mpu without a profiler runs the plain methods
+    and pays nothing. Addressing mode counts are derived from the opcode counts
+    when the report is made. Host time is measured for every sample_interval'th
+    instruction and scaled up per opcode family (i.e. op_* handler). Other
+    tools that do the same (e.g. a heatmap) have to be detached in the
+    reverse order they were attached in.
+    """
+
+    # Prime, so the samples don't line up with short polling loops (e.g. a
+    # BIT/BPL vblank wait would otherwise only ever sample the BPL).
+    def __init__(self, sample_interval=61):
+        self.sample_interval = sample_interval
+        self.mpu = None
+        # The mpu's opcode table, kept after detach() for report().
+        self._opcodes = None
+        self.opcode_counts = None
+        self.family_samples = None
+        self.family_time = None
+        self.reads = None
+        self.writes = None
+        self._countdown = None
+        self._saved = None
+        self.reset()
+
+    def reset(self):
+        self.opcode_counts = array('L', [0] * 256)
+        self.family_samples = {}
+        self.family_time = {}
+        # Indexed by 0 for direct array accesses and 1 for subscriber handled
+        # accesses.
+        self.reads = array('L', [0, 0])
+        self.writes = array('L', [0, 0])
+        self._countdown = self.sample_interval
+
+    def attach(self, mpu):
+        assert self.mpu is None
+        self.mpu = mpu
+        self._opcodes = mpu._opcodes
+
+        counts = self.opcode_counts
+        execute_opcode = mpu.execute_opcode
+        def profiled_execute_opcode(opcode):
+            counts[opcode] += 1
+            self._countdown -= 1
+            if self._countdown:
+                return execute_opcode(opcode)
+
+            self._countdown = self.sample_interval
+            start = default_timer()
+            ret = execute_opcode(opcode)
+            self._add_sample(opcode, default_timer() - start)
+            return ret
+
+        memory = mpu.memory
+        reads, writes = self.reads, self.writes
+        get_byte, set_byte = memory.get_byte, memory.set_byte
+        def counting_get_byte(offset):
+            reads[memory._read_subscribers[offset] is not None] += 1
+            return get_byte(offset)
+
+        def counting_set_byte(offset, value):
+            writes[memory._write_subscribers[offset] is not None] += 1
+            return set_byte(offset, value)
+
+        # Whatever was on the instances before (e.g. a heatmap) is put back by
+        # detach().
+        self._saved = []
+        for obj, name, wrapper in ((mpu, 'execute_opcode',
+                                    profiled_execute_opcode),
+                                   (memory, 'get_byte', counting_get_byte),
+                                   (memory, 'set_byte', counting_set_byte)):
+            self._saved.append((obj, name, obj.__dict__.get(name), wrapper))
+            setattr(obj, name, wrapper)
+
+    def detach(self):
+        assert self.mpu is not None
+        # Anything attached after the profiler wraps its methods, and would
+        # be lost (or keep calling them) if they were taken out under it.
+        for obj, name, _, wrapper in self._saved:
+            if obj.__dict__.get(name) is not wrapper:
+                raise ProfilerException('%s was replaced after the profiler '
+                                        'was attached; detach that first' %
+                                        name)
+        for obj, name, saved, _ in self._saved:
+            if saved is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, saved)
+        self.mpu = None
+
+    def _add_sample(self, opcode, elapsed):
+        family = self._opcodes[opcode][0].__name__
+        self.family_samples[family] = self.family_samples.get(family, 0) + 1
+        self.family_time[family] = self.family_time.get(family, 0.0) + elapsed
+
+    def report(self):
+        opcodes = {}
+        addrmodes = {}
+        families = {}
+        for opcode, count in enumerate(self.opcode_counts):
+            if not count:
+                continue
+            fn, addrmode, _ = self._opcodes[opcode]
+            opcodes['0x%02X' % opcode] = {
+                'count': count,
+                'handler': fn.__name__,
+                'addrmode': addrmode.mnemonic,
+            }
+            addrmodes[addrmode.mnemonic] = (
+                addrmodes.get(addrmode.mnemonic, 0) + count
+            )
+            family = families.setdefault(fn.__name__, {'count': 0})
+            family['count'] += count
+
+        for name, family in families.items():
+            samples = self.family_samples.get(name, 0)
+            sampled_time = self.family_time.get(name, 0.0)
+            family['samples'] = samples
+            family['sampled_time'] = sampled_time
+            family['estimated_time'] = (
+                sampled_time / samples * family['count'] if samples else None
+            )
+
+        return {
+            'instructions': sum(self.opcode_counts),
+            'sample_interval': self.sample_interval,
+            'opcodes': opcodes,
+            'addrmodes': addrmodes,
+            'families': families,
+            'bus': {
+                'reads': {'direct': self.reads[0],
+                          'subscriber': self.reads[1]},
+                'writes': {'direct': self.writes[0],
+                           'subscriber': self.writes[1]},
+            },
+        }
+
+    def write_report(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2, sort_keys=True)
+            file.write('\n')
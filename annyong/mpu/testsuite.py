@@ -1,110 +1,112 @@
+from __future__ import print_function
+
+import multiprocessing
 import os
-import sys
+from timeit import default_timer
+from xml.sax.saxutils import escape, quoteattr
 
+from annyong.mpu.assembler import AssemblerException, assemble
 from annyong.mpu.mpu6502 import Mpu6502
+from annyong.util.compat import xrange
+
+class TestCase(object):
+    def __init__(self, path, name, code, asserts):
+        self.path = path
+        self.name = name
+        self.code = code
+        self.asserts = asserts
+
+class TestResult(object):
+    def __init__(self, case, failures, time):
+        self.case = case
+        self.failures = failures
+        self.time = time
+
+    @property
+    def success(self):
+        return not self.failures
+
+def parse_file(path):
+    with open(path, 'r') as file:
+        lines = file.read().split('\n')
+
+    cases = []
+    while lines:
+        line = lines.pop(0)
+        if not line.startswith('test'):
+            continue
+        test_name = line[5:]
+
+        code = []
+        while (lines and
+               not lines[0].startswith('assert') and
+               not lines[0].startswith('test')):
+            code.append(lines.pop(0))
+
+        asserts = []
+        while lines and lines[0].startswith('assert'):
+            asserts.append(lines.pop(0).split())
+
+        cases.append(TestCase(path, test_name, code, asserts))
+    return cases
+
+class CpuHarness(object):
+    """
+    Runs test cases on an Mpu6502 of its own, without the rest of the NES.
+
+    It stands in for the NES as far as the mpu is concerned (no tracing), and
+    resets the mpu before every test case. The tests are written for a plain
+    6502, so the mpu is the NMOS variant (i.e. with decimal mode).
+    """
+
+    # The test programs end with an invalid opcode (`.byte 2`); this is the
+    # upper limit for programs that never get there.
+    MAX_STEPS = 100000
+
+    logfile = None
+    analysis = None
 
-class TestSuite(object):
     def __init__(self):
-        self.mpu = Mpu6502()
-        self.mpu.set_trace_output(sys.stdout)
-        self.successive_tests = None
-        self.failed_tests = None
+        self.mpu = Mpu6502(self, Mpu6502.VARIANT_NMOS)
 
-    def run(self, path):
-        if not os.path.exists(path):
-            print "Path not found: %s" % path
-            print "Couldn't start testsuite :-/"
-            return
+    def log(self, msg):
+        pass
 
-        self.successive_tests = 0
-        self.failed_tests = 0
+    def run_case(self, case):
+        start = default_timer()
+        failures = self._run_case(case)
+        return TestResult(case, failures, default_timer() - start)
 
-        if os.path.isdir(path):
-            for filename in os.listdir(path):
-                if not filename.endswith('.t'):
-                    continue
-                self.test_file(os.path.join(path, filename))
-        else:
-            self.test_file(path)
-
-        print "Failed %d/%d tests" % (self.failed_tests,
-                                      self.failed_tests + self.successive_tests)
-
-    def test_file(self, path):
-        file = open(path, 'r')
-        contents = file.read()
-        file.close()
-
-        # Remove empty lines
-        contents = filter(len, contents)
-
-        contents = contents.split('\n')
-        while contents:
-            test_name = contents.pop(0)[5:]
-            if test_name == '':
-                continue
-
-            code = []
-            while (contents and
-                   not contents[0].startswith('assert') and
-                   not contents[0].startswith('test')):
-                code.append(contents.pop(0))
-
-            asserts = []
-            while contents and contents[0].startswith('assert'):
-                asserts.append(contents.pop(0).split())
-
-            print "Running %s" % test_name
-            was_success = self.run_test(code, asserts)
-            if was_success:
-                self.successive_tests += 1
-            else:
-                self.failed_tests += 1
-                print '%s, %s: FAIL' % (path, test_name)
-
-    def run_test(self, code, asserts):
-        file = open('asm.tmp', 'w')
-        file.write('\n'.join(code))
-        file.close()
-
-        compile_success = 0 == os.system('xa -C -W -bt0 asm.tmp')
-        if not compile_success:
-            print "Couldn't compile test"
-            os.unlink("asm.tmp")
-            os.unlink("a.o65")
-            return False
-
-        file = open('a.o65', 'rb')
-        raw = file.read()
-        file.close()
+    def _run_case(self, case):
+        try:
+            raw = assemble('\n'.join(case.code))
+        except AssemblerException as e:
+            return ["Couldn't compile test: %s" % e]
 
         self.mpu.reset()
         self.mpu.memory.copy_from_raw(raw, 0)
-
-        os.unlink("asm.tmp")
-        os.unlink("a.o65")
+        self.mpu.reg.pc = 0
 
         try:
-            self.mpu.run(0)
-        except Mpu6502.InvalidOpcodeException, e:
+            for i in xrange(CpuHarness.MAX_STEPS):
+                self.mpu.step()
+            return ['Still running after %d steps' % CpuHarness.MAX_STEPS]
+        except Mpu6502.InvalidOpcodeException as e:
             if e.get_opcode() != 2:
-                print str(e)
-                exit(1) # TODO
-                return False
-
-        # Run through every assertion
-        asserts_success = True
-        for assertType, source, value in asserts:
-            if not self.check_assertion(assertType, source, value):
-                asserts_success = False
+                return [str(e)]
 
-        return asserts_success
+        failures = []
+        for assertType, source, value in case.asserts:
+            failure = self.check_assertion(assertType, source, value)
+            if failure:
+                failures.append(failure)
+        return failures
 
     def check_assertion(self, assertType, str_source, str_value):
+        # Returns a description of the failure, or None.
         if str_source.startswith('mem.'):
             # We're comparing with a place in memory
-            # Might be prefixed by 0x to indicate hex. strtol() takes care of
-            # this!
+            # Might be prefixed by 0x to indicate hex.
             loc = str_source.split('.')[1]
             loc = int(loc, 16 if 'x' in loc else 10)
             source = self.mpu.memory.get_byte(loc)
@@ -127,44 +129,118 @@ class TestSuite(object):
             elif char_val == 'y':
                     source = self.mpu.reg.y
             else:
-                print 'Invalid source for assertion: %s' % str_source
-                sys.exit(1)
+                return 'Invalid source for assertion: %s' % str_source
 
         elif str_source.startswith('flags.'):
-            char_val = str_source[6]
-            if char_val == 'b':
-                source = self.mpu.reg.ps.break_
-            elif char_val == 'z':
-                source = self.mpu.reg.ps.zero
-            elif char_val == 'n':
-                source = self.mpu.reg.ps.negative
-            elif char_val == 'c':
-                source = self.mpu.reg.ps.carry
-            elif char_val == 'd':
-                source = self.mpu.reg.ps.decimal
-            elif char_val == 'i':
-                source = self.mpu.reg.ps.interrupt
-            elif char_val == 'v':
-                source = self.mpu.reg.ps.overflow
-            else:
-                print 'Invalid source for assertion: %s' % str_source
-                sys.exit(1)
+            flags = {
+                'b': 'break_', 'z': 'zero', 'n': 'negative', 'c': 'carry',
+                'd': 'decimal', 'i': 'interrupt', 'v': 'overflow',
+            }
+            if str_source[6] not in flags:
+                return 'Invalid source for assertion: %s' % str_source
+            source = getattr(self.mpu.reg.ps, flags[str_source[6]])
         else:
-            print 'Invalid source for assertion: %s' % str_source
-            sys.exit(1)
+            return 'Invalid source for assertion: %s' % str_source
 
         value = int(str_value, 16 if 'x' in str_value else 10)
 
         if source != value:
-            print "Failed assertion: '%s %s %s' %s != %s" % (
+            return "Failed assertion: '%s %s %s' %s != %s %s" % (
                 assertType,
                 str_source,
                 str_value,
                 source,
-                value
+                value,
+                self.mpu,
             )
-            print self.mpu
-            sys.exit(1)
-            return False
-        
-        return True
+        return None
+
+# Every pool worker gets a harness (and so an mpu) of its own.
+_harness = None
+
+def _init_worker():
+    global _harness
+    _harness = CpuHarness()
+
+def _run_case(case):
+    return _harness.run_case(case)
+
+class TestSuite(object):
+    def __init__(self, jobs=None):
+        # Number of worker processes; None for one per cpu, 1 to run in this
+        # process.
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.results = None
+
+    def collect(self, path):
+        if os.path.isdir(path):
+            paths = [os.path.join(path, filename)
+                     for filename in sorted(os.listdir(path))
+                     if filename.endswith('.t')]
+        else:
+            paths = [path]
+        return [case for path in paths for case in parse_file(path)]
+
+    def run(self, path):
+        if not os.path.exists(path):
+            print("Path not found: %s" % path)
+            print("Couldn't start testsuite :-/")
+            return None
+
+        cases = self.collect(path)
+        start = default_timer()
+        if self.jobs == 1:
+            harness = CpuHarness()
+            self.results = [harness.run_case(case) for case in cases]
+        else:
+            pool = multiprocessing.Pool(self.jobs, _init_worker)
+            try:
+                self.results = pool.map(_run_case, cases, chunksize=8)
+            finally:
+                pool.terminate()
+        elapsed = default_timer() - start
+
+        failed = [result for result in self.results if not result.success]
+        for result in failed:
+            print('%s, %s: FAIL' % (result.case.path, result.case.name))
+            for failure in result.failures:
+                print('    %s' % failure)
+
+        print("Failed %d/%d tests in %.2fs" % (len(failed), len(self.results),
+                                               elapsed))
+        return self.results
+
+    def write_junit(self, path):
+        suites = []
+        for result in self.results:
+            if not suites or suites[-1][0] != result.case.path:
+                suites.append((result.case.path, []))
+            suites[-1][1].append(result)
+
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<testsuites>']
+        for suite_path, results in suites:
+            lines.append('  <testsuite name=%s tests="%d" failures="%d" '
+                         'time="%.6f">' % (
+                quoteattr(suite_path),
+                len(results),
+                len([r for r in results if not r.success]),
+                sum(r.time for r in results),
+            ))
+            classname = os.path.splitext(os.path.basename(suite_path))[0]
+            for result in results:
+                lines.append('    <testcase classname=%s name=%s '
+                             'time="%.6f">' % (
+                    quoteattr(classname),
+                    quoteattr(result.case.name),
+                    result.time,
+                ))
+                for failure in result.failures:
+                    lines.append('      <failure message=%s>%s</failure>' % (
+                        quoteattr(failure.split('\n')[0]), escape(failure),
+                    ))
+                lines.append('    </testcase>')
+            lines.append('  </testsuite>')
+        lines.append('</testsuites>')
+
+        with open(path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
@@ -1,25 +1,46 @@
 from __future__ import absolute_import
 
-import sys
-
+from annyong.controller import Controller
+from annyong.debugger import Debugger
 from annyong.mappers.mapper0 import Mapper0
+from annyong.mpu import analyzer
 from annyong.mpu.mpu6502 import Mpu6502
+from annyong.ppu.engine import ENGINES
 from annyong.ppu.ppu import PPU
 from annyong.rom import Rom
+from annyong.runahead import RunAhead
 
 class NES(object):
     # Indexed by iNES' mapper ids.
     mappers = (
         Mapper0,
     )
-    def __init__(self, logfile=None):
+    # NTSC
+    FRAME_TIME = 1 / 60.0988
+
+    def __init__(self, logfile=None, engine='scanline'):
+        # engine is the name of one of annyong.ppu.engine.ENGINES.
         self.mpu = Mpu6502(self)
         self.ppu = PPU(self)
+        self.engine = ENGINES[engine](self)
         self.rom = Rom()
+        # Joypads 1 and 2, read through $4016 and $4017.
+        self.controllers = (Controller(), Controller())
         self.mapper = None
         self.frame_num = None
-        self.logfile = logfile or open('trace.log', 'w')
+        # Gets a line per instruction (see Mpu6502.trace()) when set.
+        self.logfile = logfile
         self.ppucycles = None
+        self.run_ahead = None
+        self.sinks = []
+        self.analysis = None
+        self.debugger = Debugger(self)
+        # Set while a frame or scanline has been left half done by a debugger
+        # break; see emulate_frame().
+        self.mid_frame = False
+        self.mid_scanline = False
+        # The state right after load_rom(), for power_cycle().
+        self._power_on = None
 
     def log(self, msg):
         if self.logfile:
@@ -31,6 +52,11 @@ class NES(object):
         self.mpu.reset()
         self.frame_num = 0
         self.ppucycles = 0
+        self.mid_frame = False
+        self.mid_scanline = False
+        self.engine.reset()
+        for controller in self.controllers:
+            controller.reset()
 
         with open(path, 'rb') as file:
             raw = file.read()
@@ -42,50 +68,143 @@ class NES(object):
         # Initializes read/write subscribers, and loads the rom into
         # the mpu and ppu.
         self.mapper.connect()
-        
-    def start(self):
+        self.analysis = None
+        self._power_on = self.snapshot()
+
+    def power_cycle(self):
+        # Back to the state load_rom() left, without reloading anything: the
+        # memory and tables are overwritten in place, and the mapper's
+        # subscribers stay as they are.
+        assert self._power_on is not None, 'no ROM loaded'
+        self.restore(self._power_on)
+
+    def soft_reset(self):
+        # The reset button: the mpu goes through the reset vector and the PPU
+        # clears its control registers, while RAM, VRAM and the frame timing
+        # are left alone.
+        self.ppu.ctrlreg1.set(0)
+        self.ppu.ctrlreg2.set(0)
+        self.ppu.first_write = True
         self.mpu.interrupt('reset')
-        while True:
-            self.frame()
 
-    def frame(self):
-        self.frame_num += 1
-
-        sys.stderr.write("Frame %04d\n" % self.frame_num)
-        self.log('Frame %04d' % self.frame_num)
+    def analyze(self, cache_dir=analyzer.CACHE_DIR):
+        # Static analysis of the loaded ROM. Once it's there, the trace labels
+        # subroutines and jump targets.
+        self.analysis = analyzer.analyze_rom(self.rom, cache_dir)
+        return self.analysis
+
+    def snapshot(self):
+        return {
+            'mpu': self.mpu.snapshot(),
+            'ppu': self.ppu.snapshot(),
+            'frame_num': self.frame_num,
+            'ppucycles': self.ppucycles,
+            'mid_frame': self.mid_frame,
+            'mid_scanline': self.mid_scanline,
+            'engine': self.engine.snapshot(),
+            'controllers': [c.snapshot() for c in self.controllers],
+        }
+
+    def restore(self, state):
+        self.mpu.restore(state['mpu'])
+        self.ppu.restore(state['ppu'])
+        self.frame_num = state['frame_num']
+        self.ppucycles = state['ppucycles']
+        self.mid_frame = state['mid_frame']
+        self.mid_scanline = state['mid_scanline']
+        self.engine.restore(state['engine'])
+        for controller, saved in zip(self.controllers, state['controllers']):
+            controller.restore(saved)
+
+    def reg_joypad(self, offset):
+        return self.controllers[offset - 0x4016].read()
+
+    def reg_joypad_strobe(self, offset, value):
+        # The strobe goes to both joypads.
+        for controller in self.controllers:
+            controller.write(value)
+
+    def set_run_ahead(self, frames):
+        self.run_ahead = RunAhead(self, frames) if frames else None
+
+    def add_sink(self, sink):
+        # Sinks are called with the NES after every frame that was drawn. See
+        # annyong.sinks.
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def start(self, frames=None, render_every=1):
+        self.mpu.interrupt('reset')
+        self.run_frames(frames, render_every)
 
+    def frame(self):
+        if not self.mid_frame:
+            self.log('Frame %04d' % (self.frame_num + 1))
+
+        self.run_frame()
+
+        if not self.ppu.skip_rendering:
+            for sink in self.sinks:
+                sink(self)
+
+    def iter_frames(self, count=None, render_every=1):
+        # Runs `count` frames (forever if None) and yields after every one
+        # that was drawn, i.e. every render_every'th (none if it's None). The
+        # others still go through the same vblank and loopy_v updates, so the
+        # game can't tell the difference.
+        ppu = self.ppu
+        skip_rendering = ppu.skip_rendering
+        i = 0
+        try:
+            while count is None or i < count:
+                i += 1
+                ppu.skip_rendering = (
+                    skip_rendering or not render_every or i % render_every != 0
+                )
+                self.frame()
+                if not ppu.skip_rendering:
+                    yield self
+        finally:
+            ppu.skip_rendering = skip_rendering
+
+    def run_frames(self, count, render_every=1):
+        for _ in self.iter_frames(count, render_every):
+            pass
+
+    def run_frame(self):
+        # The next frame to present, which comes from the future when
+        # run-ahead is enabled.
+        if self.run_ahead:
+            self.run_ahead.frame()
+        else:
+            self.emulate_frame()
+
+    def emulate_frame(self):
+        # Runs the mpu and ppu until the ppu has wrapped around to the
+        # pre-render scanline. When a debugger break interrupts it, the next
+        # call picks up at the instruction it stopped at.
+        if not self.mid_frame:
+            self.frame_num += 1
+            self.mid_frame = True
+
+        engine = self.engine
         while True:
-            self.ppu.start_scanline()
+            if not self.mid_scanline:
+                engine.start_scanline()
+                self.mid_scanline = True
 
-            if self.ppu.scanline == 241 and self.ppu.ctrlreg1.nmi_on_vblank:
-                self.ppucycles += self.mpu.interrupt('nmi') * 3
+                if (self.ppu.scanline == 241 and
+                        self.ppu.ctrlreg1.nmi_on_vblank):
+                    self.ppucycles += self.mpu.interrupt('nmi') * 3
 
-            while self.ppucycles < 341:
-                self.ppucycles += self.mpu.step() * 3
-            self.ppucycles -= 341
+            engine.run_mpu()
 
-            self.ppu.end_scanline()
+            self.mid_scanline = False
+            engine.end_scanline()
 
             if self.ppu.scanline == -1:
                 break
 
-        print "Screen"
-        print self.format_buffer(self.ppu.screen, 256, 240)
-
-        buffers = self.ppu.render_nametable()
-        for base, buffer in buffers.iteritems():
-            print "Name table %04X" % base
-            print self.format_buffer(buffer, 256, 240)
-
-        buffers = self.ppu.render_pattern_tables()
-        for base, buffer in buffers.iteritems():
-            print "Pattern table %04X" % base
-            print self.format_buffer(buffer, 128, 128)
-    
-    def format_buffer(self, buffer, w, h):
-        ret = ''
-        for y in xrange(h):
-            for x in xrange(w):
-                ret += str(buffer[y * w + x])
-            ret += '\n'
-        return ret.replace('0', '.').strip()
+        self.mid_frame = False
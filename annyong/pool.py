@@ -0,0 +1,67 @@
+from annyong.nes import NES
+from annyong.util.compat import xrange
+
+class PoolException(BaseException):
+    pass
+
+def _overrides(obj):
+    # Methods replaced on the instance, e.g. by a profiler, heatmap or
+    # replay recorder that's still attached.
+    return [name for name in vars(obj) if hasattr(type(obj), name)]
+
+class NESPool(object):
+    """
+    NES instances with a ROM loaded, for running lots of short sessions
+    against the same ROM.
+
+    acquire() hands out an instance in its power-on state (see
+    NES.power_cycle()), building one only when none are free; release()
+    puts it back. Like a NES that just loaded the ROM, it hasn't gone
+    through the reset vector yet, so call start() (or
+    mpu.interrupt('reset')) to run it. Sinks are closed and removed, and
+    run-ahead and the debugger's points are removed on release, so every
+    session starts out the same; tools that replace methods on the instances
+    have to be detached before that. `size` instances are built up front.
+    """
+
+    def __init__(self, path, size=0, **kwargs):
+        # kwargs are passed on to NES().
+        self.path = path
+        self.kwargs = kwargs
+        self.created = 0
+        self._free = []
+        for i in xrange(size):
+            self._free.append(self._create())
+
+    def _create(self):
+        nes = NES(**self.kwargs)
+        nes.load_rom(self.path)
+        self.created += 1
+        return nes
+
+    def acquire(self):
+        if self._free:
+            return self._free.pop()
+        return self._create()
+
+    def release(self, nes):
+        nes.debugger.reset()
+        leftovers = ['%s.%s' % (type(obj).__name__, name)
+                     for obj in (nes, nes.mpu, nes.mpu.memory)
+                     for name in _overrides(obj)]
+        if leftovers:
+            raise PoolException('%s still replaced; detach whatever did it '
+                                'first' % ', '.join(leftovers))
+
+        for sink in nes.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+        nes.sinks = []
+        nes.set_run_ahead(None)
+        nes.ppu.skip_rendering = False
+        nes.power_cycle()
+        self._free.append(nes)
+
+    def __len__(self):
+        # The number of free instances.
+        return len(self._free)
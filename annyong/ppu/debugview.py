@@ -0,0 +1,121 @@
+from array import array
+
+from annyong.util.compat import xrange
+
+NTABLE_BASES = (0x2000, 0x2400, 0x2800, 0x2C00)
+PTABLE_BASES = (0x0000, 0x1000)
+
+def _draw_tile(chr, base, buffer, offset, stride):
+    # Draws the 8x8 tile at chr[base] to buffer[offset], stride bytes per
+    # row.
+    for y in xrange(base, base + 8):
+        low = chr[y]
+        high = chr[y + 8] << 1
+        buffer[offset:offset + 8] = array('B', [
+            ((low >> shift) & 1) | ((high >> shift) & 2)
+            for shift in (7, 6, 5, 4, 3, 2, 1, 0)
+        ])
+        offset += stride
+
+class DebugViews(object):
+    """
+    The name tables and pattern tables as pictures, kept up to date
+    incrementally.
+
+    The buffers persist between calls, and only tiles that changed since the
+    last call are redrawn: the PPU bumps chr_versions on CHR writes and tells
+    ntable_written() about name table writes. Anything that changes the
+    tables behind the PPU's back (loading CHR ROM, restoring a snapshot) has
+    to call invalidate().
+    """
+
+    def __init__(self, ppu):
+        self.ppu = ppu
+        self.nametable_buffers = dict(
+            (base, array('B', b'\0' * (256 * 240))) for base in NTABLE_BASES
+        )
+        self.pattern_buffers = dict(
+            (base, array('B', b'\0' * (128 * 128))) for base in PTABLE_BASES
+        )
+        # Tiles drawn so far, for seeing how much is saved.
+        self.tiles_drawn = 0
+        self._dirty_cells = None
+        self._pattern_versions = None
+        self._nametable_versions = None
+        self._pattern_dirty_all = None
+        self._bg_tbl_addr = None
+        self.invalidate()
+
+    def invalidate(self):
+        self._dirty_cells = [set(xrange(960)) for base in NTABLE_BASES]
+        # The chr_versions each view was last drawn with.
+        self._pattern_versions = array('L', [0] * 512)
+        self._nametable_versions = array('L', [0] * 512)
+        # Redraw everything the next time.
+        self._pattern_dirty_all = True
+        self._bg_tbl_addr = None
+
+    def ntable_written(self, nt_idx, offset):
+        # offset is within the name table, attributes included.
+        if offset < 0x3C0:
+            self._dirty_cells[nt_idx].add(offset)
+            return
+        # An attribute byte covers 4x4 tiles.
+        offset -= 0x3C0
+        top, left = (offset >> 3) * 4, (offset & 7) * 4
+        for y in xrange(top, min(top + 4, 30)):
+            for x in xrange(left, left + 4):
+                self._dirty_cells[nt_idx].add(y * 32 + x)
+
+    def nametables(self):
+        # {base: 256x240 buffer of 2 bit pixels}, for the 4 physical name
+        # tables. The buffers are reused; don't modify them.
+        ppu = self.ppu
+        bg = ppu.ctrlreg1.bg_tbl_addr
+        versions = ppu.chr_versions
+        drawn = self._nametable_versions
+
+        changed = set()
+        for idx in xrange(256):
+            if versions[bg * 256 + idx] != drawn[bg * 256 + idx]:
+                changed.add(idx)
+        if bg != self._bg_tbl_addr:
+            changed = set(xrange(256))
+            self._bg_tbl_addr = bg
+        drawn[:] = versions
+
+        chr, vram = ppu.chr, ppu.vram
+        pattern_base = ppu.chr_banks[bg]
+        for nt_idx, base in enumerate(NTABLE_BASES):
+            start = nt_idx * 0x400
+            cells = self._dirty_cells[nt_idx]
+            if changed:
+                cells.update(cell for cell in xrange(960)
+                             if vram[start + cell] in changed)
+
+            buffer = self.nametable_buffers[base]
+            for cell in cells:
+                y, x = cell >> 5, cell & 31
+                _draw_tile(chr, pattern_base + (vram[start + cell] << 4),
+                           buffer, y * 8 * 256 + x * 8, 256)
+            self.tiles_drawn += len(cells)
+            cells.clear()
+        return self.nametable_buffers
+
+    def pattern_tables(self):
+        # {base: 128x128 buffer of 2 bit pixels}, 16x16 tiles each.
+        ppu = self.ppu
+        versions = ppu.chr_versions
+        drawn = self._pattern_versions
+        for pt_idx, base in enumerate(PTABLE_BASES):
+            buffer = self.pattern_buffers[base]
+            for idx in xrange(256):
+                key = pt_idx * 256 + idx
+                if versions[key] == drawn[key] and not self._pattern_dirty_all:
+                    continue
+                _draw_tile(ppu.chr, ppu.chr_banks[pt_idx] + (idx << 4),
+                           buffer, (idx >> 4) * 8 * 128 + (idx & 15) * 8, 128)
+                self.tiles_drawn += 1
+        drawn[:] = versions
+        self._pattern_dirty_all = False
+        return self.pattern_buffers
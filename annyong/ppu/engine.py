@@ -0,0 +1,193 @@
+from annyong.util.compat import xrange
+
+class ScanlineEngine(object):
+    """
+    Runs the mpu a scanline at a time, and has the PPU draw the whole
+    scanline when it ends.
+
+    Fast, but anything the mpu changes in the middle of a scanline (e.g. a
+    scroll split) only shows up on the next one.
+    """
+
+    name = 'scanline'
+
+    def __init__(self, nes):
+        self.nes = nes
+
+    def reset(self):
+        pass
+
+    def start_scanline(self):
+        self.nes.ppu.start_scanline()
+
+    def run_mpu(self):
+        # Runs the mpu until the scanline's 341 ppu cycles have passed.
+        # (mpu.step is looked up every time, since the debugger may replace it
+        # in the middle of the scanline.)
+        nes = self.nes
+        mpu = nes.mpu
+        while nes.ppucycles < 341:
+            nes.ppucycles += mpu.step() * 3
+        nes.ppucycles -= 341
+
+    def end_scanline(self):
+        self.nes.ppu.end_scanline()
+
+    def snapshot(self):
+        return None
+
+    def restore(self, state):
+        pass
+
+class DotEngine(object):
+    """
+    Draws the background a dot at a time, in step with the mpu.
+
+    Follows the real PPU's pipeline: the name table and pattern bytes of
+    every tile are fetched over 8 dots, loaded into 16 bit shift registers
+    that are shifted once per dot, and loopy_v is incremented and reloaded
+    from loopy_t at the dots the hardware does it. The mpu runs an
+    instruction at a time, and the ppu catches up after each one, so
+    mid-scanline writes take effect at (about) the right dot.
+
+    The screen gets the same 2 bit pattern values as with ScanlineEngine;
+    attribute bytes aren't fetched since nothing uses them yet.
+    """
+
+    name = 'dot'
+
+    def __init__(self, nes):
+        self.nes = nes
+        self.dot = None
+        self.next_tile = None
+        self.next_low = None
+        self.next_high = None
+        self.shift_low = None
+        self.shift_high = None
+        self.reset()
+
+    def reset(self):
+        self.dot = 0
+        self.next_tile = 0
+        self.next_low = 0
+        self.next_high = 0
+        self.shift_low = 0
+        self.shift_high = 0
+
+    def start_scanline(self):
+        ppu = self.nes.ppu
+        self.dot = 0
+        if ppu.scanline == -1:
+            ppu.statusreg.vblank = 0
+            ppu.statusreg.scanline_spr_count = 0
+            ppu.statusreg.spr0_hit = 0
+        elif ppu.scanline == 241:
+            ppu.statusreg.vblank = 1
+
+    def run_mpu(self):
+        nes = self.nes
+        mpu = nes.mpu
+        # Whatever the last instruction of the previous scanline ran over.
+        self.run_dots(min(nes.ppucycles, 341))
+        while nes.ppucycles < 341:
+            nes.ppucycles += mpu.step() * 3
+            self.run_dots(min(nes.ppucycles, 341))
+        nes.ppucycles -= 341
+
+    def end_scanline(self):
+        ppu = self.nes.ppu
+        ppu.scanline += 1
+        if ppu.scanline == 262:
+            ppu.scanline = -1
+
+    def run_dots(self, end):
+        # Runs the dots up to (not including) end.
+        ppu = self.nes.ppu
+        scanline = ppu.scanline
+        if (not -1 <= scanline <= 239 or not ppu.has_visible() or
+                self.dot >= end):
+            self.dot = max(self.dot, end)
+            return
+
+        draw = scanline >= 0 and not ppu.skip_rendering
+        screen = ppu.screen
+        row = scanline * 256 - 1
+        fine_x = 15 - ppu.fine_x
+        pattern_base = ppu.chr_banks[ppu.ctrlreg1.bg_tbl_addr]
+        chr = ppu.chr
+        vram = ppu.vram
+        ntable_offsets = ppu.ntable_offsets
+        v = ppu.loopy_v
+        low, high = self.shift_low, self.shift_high
+
+        for dot in xrange(self.dot, end):
+            if 2 <= dot <= 257 or 321 <= dot <= 337:
+                low = (low << 1) & 0xFFFF
+                high = (high << 1) & 0xFFFF
+
+                phase = (dot - 1) & 7
+                if phase == 0:
+                    # Reload, and fetch the name table byte
+                    low |= self.next_low
+                    high |= self.next_high
+                    self.next_tile = vram[ntable_offsets[(v >> 10) & 3] |
+                                          (v & 0x3FF)]
+                elif phase == 4:
+                    self.next_low = chr[pattern_base +
+                                        ((self.next_tile << 4) | (v >> 12))]
+                elif phase == 6:
+                    self.next_high = chr[pattern_base +
+                                         ((self.next_tile << 4) | 8 |
+                                          (v >> 12))]
+                elif phase == 7:
+                    # Coarse x
+                    if v & 0x1F == 31:
+                        v = (v & ~0x1F) ^ 0x400
+                    else:
+                        v += 1
+
+            if dot == 256:
+                # Fine y, then coarse y (wrapping at the attribute table)
+                if v & 0x7000 != 0x7000:
+                    v += 0x1000
+                else:
+                    v &= ~0x7000
+                    y = (v & 0x3E0) >> 5
+                    if y == 29:
+                        y = 0
+                        v ^= 0x800
+                    elif y == 31:
+                        y = 0
+                    else:
+                        y += 1
+                    v = (v & ~0x3E0) | (y << 5)
+            elif dot == 257:
+                v = (v & ~0x41F) | (ppu.loopy_t & 0x41F)
+            elif scanline == -1 and 280 <= dot <= 304:
+                v = (v & ~0x7BE0) | (ppu.loopy_t & 0x7BE0)
+
+            if draw and 1 <= dot <= 256:
+                screen[row + dot] = (((high >> fine_x) & 1) << 1 |
+                                     ((low >> fine_x) & 1))
+
+        self.dot = end
+        ppu.loopy_v = v
+        self.shift_low, self.shift_high = low, high
+
+    def snapshot(self):
+        return (self.dot, self.next_tile, self.next_low, self.next_high,
+                self.shift_low, self.shift_high)
+
+    def restore(self, state):
+        # None is a ScanlineEngine snapshot, taken between frames; the shift
+        # registers are filled again on the pre-render scanline.
+        if state is None:
+            self.reset()
+            return
+        (self.dot, self.next_tile, self.next_low, self.next_high,
+         self.shift_low, self.shift_high) = state
+
+ENGINES = {
+    ScanlineEngine.name: ScanlineEngine,
+    DotEngine.name: DotEngine,
+}
@@ -1,15 +1,29 @@
 from array import array
 
-from annyong.ppu.ntable import NTable
-from annyong.ppu.ptable import PTable
+from annyong.ppu.debugview import DebugViews
+from annyong.ppu.tilecache import TileCache
 from annyong.util.bitset import Bitset
+from annyong.util.compat import xrange
 
 class PPU(object):
     def __init__(self, nes):
         self.nes = nes
-        self.ptables = None
-        self.ntables = None
+        # The PPU's memory: pattern tables (CHR ROM or RAM), the 4 name tables
+        # (including their attributes) and the palettes, background first.
+        # They're only ever modified in place, since _build_map() keeps
+        # references to them.
+        self.chr = None
+        self.vram = None
+        self.palette = None
+        # The physical name table of each of $2000, $2400, $2800 and $2C00,
+        # and where they start in vram.
         self.ntable_mirror = None
+        self.ntable_offsets = None
+        # Where the pattern tables at $0000 and $1000 start in chr.
+        self.chr_banks = None
+        self._map_buffers = None
+        self._map_offsets = None
+        self._map_key = None
         self.ctrlreg1 = Bitset(
             ('name_tbl_addr',       2), # 1-2
             ('ppu_addr_inc',        1), # 3
@@ -43,8 +57,18 @@ class PPU(object):
         self.vram_buffer = None
         self.scanline = None
         self.screen = None
-        self.bg_palette = None
-        self.spr_palette = None
+        # Bumped on every write to a tile, indexed by (pattern table << 8) |
+        # tile index.
+        self.chr_versions = None
+        # Created by the first render_nametable()/render_pattern_tables(),
+        # since most runs never look at them.
+        self.views = None
+        self.tile_cache = None
+        # When set, visible scanlines only update loopy_v and leave the screen
+        # untouched (used for frames that are never presented). Anything the
+        # mpu can observe (e.g. sprite 0 hits, once they're implemented) has
+        # to be kept up to date in this mode as well.
+        self.skip_rendering = False
 
         self.reset()
 
@@ -68,67 +92,78 @@ class PPU(object):
         )
     __repr__ = __str__
 
-    def _memory_map(self, offset, value=None):
-        offset = offset & 0x3FFF
-
-        # pattern table
-        if offset < 0x2000:
-            pt_idx = offset >> 12
-            tile_idx = (offset & 0xFF0) >> 4
-
-            tbl = self.ptables[pt_idx].get_tile(tile_idx).memory
-            tbl_idx = offset & 0xF
-
-        # name table
-        elif offset < 0x3000:
-            nt_idx = self.ntable_mirror[(offset & 0xF00) >> 10]
-            ntable = self.ntables[nt_idx]
-            low = offset & 0x3FF
-            if low < 0x3C0:
-                tbl = ntable.indexes
-                tbl_idx = low
-            else:
-                tbl = ntable.attribs
-                tbl_idx = low - 0x3C0
-
-        # mirror
-        elif offset < 0x3F00:
-            return self._memory_map(offset - 0x1000, value)
-
-        # image palette
-        elif offset < 0x3F10:
-            tbl = self.bg_palette
-            tbl_idx = offset - 0x3F00
-
-        # sprite palette
-        elif offset < 0x3F20:
-            if offset % 4 == 0:
-                return self._memory_map(offset - 0x10, value)
-
-            tbl = self.spr_palette
-            tbl_idx = offset - 0x3F10
-        else:
-            return self._memory_map((offset & 0xFF00) | (offset & 0x1F), value)
-
-        if value is None:
-            return tbl[tbl_idx]
-        else:
-            tbl[tbl_idx] = value
+    def _build_map(self):
+        # PPU address -> (buffer, index), as two lists over the 16K address
+        # space, so get_byte() and set_byte() are a lookup rather than a
+        # decode. Depends on the mirroring and CHR banks only.
+        self.ntable_offsets = [nt_idx * 0x400 for nt_idx in self.ntable_mirror]
+        key = (tuple(self.ntable_mirror), tuple(self.chr_banks))
+        if key == self._map_key:
+            return
+        self._map_key = key
+
+        chr_offsets = []
+        for bank in self.chr_banks:
+            chr_offsets.extend(xrange(bank, bank + 0x1000))
+        ntable_offsets = []
+        for offset in self.ntable_offsets:
+            ntable_offsets.extend(xrange(offset, offset + 0x400))
+        # $3F10, $3F14, $3F18 and $3F1C are $3F00, $3F04, $3F08 and $3F0C.
+        palette_offsets = [
+            i - 0x10 if i >= 0x10 and i % 4 == 0 else i for i in xrange(0x20)
+        ]
+
+        # $3000-$3EFF mirrors $2000-$2EFF, and the palette repeats up to
+        # $3FFF.
+        self._map_buffers = (
+            [self.chr] * 0x2000 + [self.vram] * 0x1F00 +
+            [self.palette] * 0x100
+        )
+        self._map_offsets = (
+            chr_offsets + ntable_offsets + ntable_offsets[:0xF00] +
+            palette_offsets * 8
+        )
 
     def get_byte(self, offset):
-        return self._memory_map(offset)
+        offset &= 0x3FFF
+        return self._map_buffers[offset][self._map_offsets[offset]]
 
     def set_byte(self, offset, value):
-        return self._memory_map(offset, value)
+        offset &= 0x3FFF
+        buffer = self._map_buffers[offset]
+        index = self._map_offsets[offset]
+        buffer[index] = value
+        if buffer is self.chr:
+            self.chr_versions[offset >> 4] += 1
+        elif buffer is self.vram and self.views:
+            self.views.ntable_written(index >> 10, index & 0x3FF)
+
+    def load_chr(self, data):
+        # CHR ROM, or what CHR RAM starts out as. The pattern tables are the
+        # first 8K unless set_chr_banks() says otherwise.
+        data = bytearray(data)
+        self.chr[:] = array('B', data + bytearray(max(0, 0x2000 - len(data))))
+        self.set_chr_banks(0, 0x1000)
+
+    def set_chr_banks(self, low, high):
+        # The offsets in chr of the pattern tables at $0000 and $1000, for
+        # mappers that switch banks.
+        self.chr_banks = [low, high]
+        self._build_map()
+        self.invalidate_caches()
 
     def reset(self):
-        self.ptables = [PTable(), PTable()]
-        self.ntables = [NTable(self), NTable(self), NTable(self), NTable(self)]
+        self.chr = array('B', b'\0' * 0x2000)
+        self.vram = array('B', b'\0' * 0x1000)
+        self.palette = array('B', b'\0' * 0x20)
         self.ntable_mirror = [0, 1, 2, 3]
+        self.chr_banks = [0, 0x1000]
+        self._map_key = None
+        self._build_map()
         self.ctrlreg1.set(0)
         self.ctrlreg2.set(0)
         self.statusreg.set(0)
-        self.spr_ram = array('B', [0] * 256)
+        self.spr_ram = array('B', b'\0' * 256)
         self.spr_ram_addr = 0
         self.fine_x = 0
         self.first_write = True
@@ -136,15 +171,86 @@ class PPU(object):
         self.loopy_v = 0
         self.vram_buffer = 0
         self.scanline = -1
-        self.screen = [0] * (256 * 240)
-        self.bg_palette = array('B', [0] * 0x10)
-        self.spr_palette = array('B', [0] * 0x10)
+        self.screen = array('B', b'\0' * (256 * 240))
+        self.chr_versions = array('L', [0] * 512)
+        self.views = None
+        self.tile_cache = TileCache(self)
+
+    def snapshot(self):
+        return {
+            'chr': self.chr[:],
+            'chr_banks': self.chr_banks[:],
+            'vram': self.vram[:],
+            'palette': self.palette[:],
+            'ntable_mirror': self.ntable_mirror[:],
+            'regs': (int(self.ctrlreg1), int(self.ctrlreg2),
+                     int(self.statusreg)),
+            'spr_ram': self.spr_ram[:],
+            'spr_ram_addr': self.spr_ram_addr,
+            'fine_x': self.fine_x,
+            'first_write': self.first_write,
+            'loopy_t': self.loopy_t,
+            'loopy_v': self.loopy_v,
+            'vram_buffer': self.vram_buffer,
+            'scanline': self.scanline,
+            'screen': self.screen[:],
+        }
+
+    def restore(self, state):
+        banks_changed = state['chr_banks'] != self.chr_banks
+        self._restore_chr(state['chr'])
+        self.vram[:] = state['vram']
+        self.palette[:] = state['palette']
+        self.ntable_mirror = state['ntable_mirror'][:]
+        self.chr_banks = state['chr_banks'][:]
+        self._build_map()
+        ctrlreg1, ctrlreg2, statusreg = state['regs']
+        self.ctrlreg1.set(ctrlreg1)
+        self.ctrlreg2.set(ctrlreg2)
+        self.statusreg.set(statusreg)
+        self.spr_ram[:] = state['spr_ram']
+        self.spr_ram_addr = state['spr_ram_addr']
+        self.fine_x = state['fine_x']
+        self.first_write = state['first_write']
+        self.loopy_t = state['loopy_t']
+        self.loopy_v = state['loopy_v']
+        self.vram_buffer = state['vram_buffer']
+        self.scanline = state['scanline']
+        self.screen[:] = state['screen']
+        if banks_changed:
+            self.invalidate_caches()
+        elif self.views:
+            # The name tables changed behind its back.
+            self.views.invalidate()
+
+    def _restore_chr(self, chr):
+        # Bumps the version of every tile whose bytes change, so the tile
+        # cache keeps the rest (run-ahead restores every frame). Versions are
+        # never restored: a cached tile is only right for the bytes its
+        # version stood for, and an older version number could come back
+        # with other bytes.
+        if chr == self.chr:
+            return
+        versions = self.chr_versions
+        for key in xrange(512):
+            start = self.chr_banks[key >> 8] + ((key & 0xFF) << 4)
+            if chr[start:start + 16] != self.chr[start:start + 16]:
+                versions[key] += 1
+        self.chr[:] = chr
+
+    def invalidate_caches(self):
+        # For when the tables have been changed without going through
+        # set_byte(), e.g. loading CHR ROM.
+        if self.views:
+            self.views.invalidate()
+        self.tile_cache.clear()
 
     def set_mirroring(self, type):
         assert type in ['h', 'v', '4']
         if type == 'h': self.ntable_mirror = [0, 0, 1, 1]
         if type == 'v': self.ntable_mirror = [0, 1, 0, 1]
         if type == '4': self.ntable_mirror = [0, 1, 2, 3]
+        self._build_map()
 
     def has_visible(self):
         return self.ctrlreg2.bg_visibility or self.ctrlreg2.spr_visibility
@@ -236,10 +342,9 @@ class PPU(object):
 
     # 0x4014 (w)
     def reg_oam_transfer(self, offset, value):
-        data_offset = value * 0x100
-        for i in xrange(256):
-            byte = self.nes.mpu.memory.get_byte(data_offset | self.spr_ram_addr)
-            self.reg_oam_data(0x2004, value=byte)
+        # Byte i of the page goes to spr_ram[i], and spr_ram_addr ends up
+        # where it was after its 256 increments.
+        self.spr_ram[:] = self.nes.mpu.memory.read_block(value << 8, 0x100)
         self.nes.mpu.add_halt_cycles(513)
 
     # }}}
@@ -264,7 +369,10 @@ class PPU(object):
 
     def end_scanline(self):
         if self.has_visible() and (0 <= self.scanline <= 239):
-            self.render_current_scanline()
+            if self.skip_rendering:
+                self.skip_current_scanline()
+            else:
+                self.render_current_scanline()
 
         self.scanline += 1
 
@@ -288,18 +396,22 @@ class PPU(object):
     def render_current_scanline(self):
         v = self.loopy_v
         fine_y = (v >> 12) & 7
+        fine_x = self.fine_x
+        bg_tbl = self.ctrlreg1.bg_tbl_addr << 8
+        tile_rows = self.tile_cache.rows
+        vram = self.vram
+        ntable_offsets = self.ntable_offsets
+        screen = self.screen
+        offset = self.scanline * 256
         for tileno in xrange(32):
-            nt_idx = (v & 0xF00) >> 10
-            tile_x = v & 0x1F
-            tile_y = (v >> 5) & 0x1F
-
-            ntable = self.ntables[self.ntable_mirror[nt_idx]]
-            tile = ntable.get_tile(tile_x, tile_y)
-            attrib = ntable.get_attrib(tile_x, tile_y)
-
-            for x in xrange(8):
-                pixel = tile.get_pixel((x + self.fine_x) & 7, fine_y)
-                self.screen[self.scanline * 256 + tileno * 8 + x] = pixel
+            # The name table and the tile's x and y within it
+            row = tile_rows(bg_tbl |
+                            vram[ntable_offsets[(v >> 10) & 3] | (v & 0x3FF)])
+            row = row[fine_y]
+            if fine_x:
+                row = row[fine_x:] + row[:fine_x]
+            screen[offset:offset + 8] = row
+            offset += 8
 
             if tileno == 31:
                 break
@@ -312,37 +424,27 @@ class PPU(object):
                 v ^= 0x420
         self.loopy_v = v
 
+    def skip_current_scanline(self):
+        # Same loopy_v updates as render_current_scanline(), without drawing.
+        v = self.loopy_v
+        for tileno in xrange(31):
+            v += 1
+            if v & 0xFF == 0x20:
+                v ^= 0x420
+        self.loopy_v = v
+
     # }}}
 
     # Debug {{{
 
+    def _debug_views(self):
+        if not self.views:
+            self.views = DebugViews(self)
+        return self.views
+
     def render_nametable(self):
-        buffers = {}
-        for base in [0x2000, 0x2400, 0x2800, 0x2C00]:
-            buffers[base] = [None] * (256 * 240)
-            for nm_y in xrange(30):
-                for nm_x in xrange(32):
-                    ntable = self.ntables[(base & 0xF00) >> 10]
-                    tile = ntable.get_tile(nm_x, nm_y)
-                    for y in xrange(8):
-                        for x in xrange(8):
-                            pixel = tile.get_pixel(x, y)
-                            buf_idx = (nm_y * 8 + y) * 256 + (nm_x * 8 + x)
-                            buffers[base][buf_idx] = pixel
-        return buffers
+        return self._debug_views().nametables()
 
     def render_pattern_tables(self):
-        buffers = {}
-        for base in [0x0, 0x1000]:
-            buffers[base] = [None] * (16 * 8 * 16 * 8)
-            for idx in xrange(16 * 16):
-                tile = self.ptables[base >> 12].get_tile(idx)
-                for y in xrange(8):
-                    for x in xrange(8):
-                        pixel = tile.get_pixel(x, y)
-                        pt_y = idx / 16
-                        pt_x = idx % 16
-                        buf_idx = (pt_y * 8 + y) * 128 + (pt_x * 8 + x)
-                        buffers[base][buf_idx] = pixel
-        return buffers
+        return self._debug_views().pattern_tables()
     # }}}
@@ -0,0 +1,80 @@
+from array import array
+
+from annyong.util.compat import xrange
+
+class TileCache(object):
+    """
+    Decoded 8x8 tiles for the scanline renderer, so the bit planes of a tile
+    are only taken apart once rather than per pixel per scanline.
+
+    Keys are (pattern table << 8) | tile index, the same as PPU.chr_versions;
+    an entry whose version is out of date is decoded again. At most `size`
+    tiles are kept, evicting the least recently used. hits, misses and
+    evictions are counted for tuning the size.
+    """
+
+    def __init__(self, ppu, size=256):
+        self.ppu = ppu
+        self.size = size
+        self.hits = None
+        self.misses = None
+        self.evictions = None
+        self._entries = None
+        self._tick = None
+        self.clear()
+
+    def clear(self):
+        # key -> [chr version, rows, last used]
+        self._entries = {}
+        self._tick = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def rows(self, key):
+        # The tile's 8 rows, each an array of 8 two bit pixels.
+        version = self.ppu.chr_versions[key]
+        entry = self._entries.get(key)
+        self._tick += 1
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            entry[2] = self._tick
+            return entry[1]
+
+        self.misses += 1
+        if entry is None and len(self._entries) >= self.size:
+            self._evict()
+        rows = self._decode(key)
+        self._entries[key] = [version, rows, self._tick]
+        return rows
+
+    def _evict(self):
+        # Eviction only happens on a miss with a full cache, so the scan is
+        # cheaper than keeping the entries ordered on every hit.
+        oldest = min(self._entries, key=lambda key: self._entries[key][2])
+        del self._entries[oldest]
+        self.evictions += 1
+
+    def _decode(self, key):
+        chr = self.ppu.chr
+        base = self.ppu.chr_banks[key >> 8] + ((key & 0xFF) << 4)
+        rows = []
+        for y in xrange(base, base + 8):
+            low = chr[y]
+            high = chr[y + 8] << 1
+            rows.append(array('B', [
+                ((low >> shift) & 1) | ((high >> shift) & 2)
+                for shift in (7, 6, 5, 4, 3, 2, 1, 0)
+            ]))
+        return rows
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': self.size,
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else None,
+        }
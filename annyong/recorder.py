@@ -0,0 +1,114 @@
+import threading
+from array import array
+
+from annyong.ppu.palette import screen_colors, translate_planes
+from annyong.util.compat import queue, xrange
+from annyong.util.png import write_png
+
+def _rgb_to_ycbcr(r, g, b):
+    # BT.601, limited range
+    y = 16 + (65.481 * r + 128.553 * g + 24.966 * b) / 255
+    cb = 128 + (-37.797 * r - 74.203 * g + 112.0 * b) / 255
+    cr = 128 + (112.0 * r - 93.786 * g - 18.214 * b) / 255
+    return tuple(min(255, max(0, int(round(c)))) for c in (y, cb, cr))
+
+class RawVideoWriter(object):
+    # 256x240 rgb24 frames back to back.
+    def __init__(self, file):
+        self.file = file
+        self._rgb = bytearray(256 * 240 * 3)
+
+    def write(self, frame_num, pixels, colors):
+        planes = list(zip(*colors))
+        self.file.write(translate_planes(pixels, planes, self._rgb))
+
+    def close(self):
+        self.file.close()
+
+class Y4MWriter(object):
+    # YUV4MPEG2 with 4:4:4 chroma, which most players and ffmpeg understand.
+    HEADER = b'YUV4MPEG2 W256 H240 F60099:1000 Ip A1:1 C444\n'
+
+    def __init__(self, file):
+        self.file = file
+        self.file.write(Y4MWriter.HEADER)
+
+    def write(self, frame_num, pixels, colors):
+        planes = zip(*[_rgb_to_ycbcr(*color) for color in colors])
+        self.file.write(b'FRAME\n')
+        for plane in planes:
+            self.file.write(translate_planes(pixels, [plane]))
+
+    def close(self):
+        self.file.close()
+
+class PngWriter(object):
+    # One PNG per frame, written to pattern % frame number.
+    def __init__(self, pattern='frame%05d.png'):
+        self.pattern = pattern
+
+    def write(self, frame_num, pixels, colors):
+        write_png(self.pattern % frame_num, 256, 240,
+                  translate_planes(pixels, list(zip(*colors))))
+
+    def close(self):
+        pass
+
+class Recorder(object):
+    """
+    A frame sink that hands frames to a writer running in a background thread.
+
+    Frames are copied into one of `slots` preallocated buffers, which is all
+    the emulation thread does; the conversion and encoding happen in the
+    worker. Only every `every`'th frame is recorded. When all slots are in
+    use, the frame is dropped (and counted in `dropped`) with policy 'drop',
+    or the emulator waits for a free slot with policy 'block'.
+    """
+
+    def __init__(self, writer, slots=8, every=1, policy='drop'):
+        assert policy in ('drop', 'block')
+        self.writer = writer
+        self.every = every
+        self.policy = policy
+        self.recorded = 0
+        self.dropped = 0
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for i in xrange(slots):
+            # [frame number, screen, colors]
+            self._free.put([None, array('B', b'\0' * (256 * 240)), None])
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='annyong-recorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, nes):
+        if nes.frame_num % self.every:
+            return
+
+        try:
+            slot = self._free.get(self.policy == 'block')
+        except queue.Empty:
+            self.dropped += 1
+            return
+
+        slot[0] = nes.frame_num
+        slot[1][:] = nes.ppu.screen
+        slot[2] = screen_colors(nes.ppu)
+        self._filled.put(slot)
+
+    def _run(self):
+        while True:
+            slot = self._filled.get()
+            if slot is None:
+                break
+            self.writer.write(*slot)
+            self.recorded += 1
+            self._free.put(slot)
+
+    def close(self):
+        # Waits for the queued frames to be written.
+        self._filled.put(None)
+        self._thread.join()
+        self.writer.close()
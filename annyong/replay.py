@@ -0,0 +1,244 @@
+"""
+Recorded sessions that can be played back exactly, for regression testing.
+
+A replay holds the SHA-1 of the ROM, the NES snapshot it starts from, the
+joypad buttons of every frame and a checksum of the emulator state every
+`interval` frames. Playing it back restores the snapshot, feeds the same
+buttons and compares the checksums, so a change that alters emulation shows
+up at the first checkpoint after it, without storing any frames.
+
+The file is 'ANRP' followed by zlib compressed JSON; see Replay.to_json().
+"""
+
+import base64
+import hashlib
+import json
+import os
+import sys
+import zlib
+from array import array
+
+from annyong.util.compat import array_frombytes, array_tobytes
+
+_MAGIC = b'ANRP'
+
+class ReplayException(BaseException):
+    pass
+
+def state_checksum(nes):
+    """
+    CRC-32 of everything the mpu can observe: registers, memory, the PPU's
+    registers and tables, timing and the joypads. The screen isn't included,
+    so replays can be verified without rendering.
+    """
+    mpu, ppu = nes.mpu, nes.ppu
+    reg = mpu.reg
+    crc = zlib.crc32(repr((
+        reg.pc, reg.sp, reg.ac, reg.x, reg.y, int(reg.ps), mpu.cycles,
+        mpu.halt_cycles, nes.ppucycles, int(ppu.ctrlreg1), int(ppu.ctrlreg2),
+        int(ppu.statusreg), ppu.spr_ram_addr, ppu.fine_x, ppu.first_write,
+        ppu.loopy_t, ppu.loopy_v, ppu.vram_buffer, ppu.scanline,
+        ppu.ntable_mirror, [c.snapshot() for c in nes.controllers],
+    )).encode('ascii'))
+    buffers = [mpu.memory.snapshot(), ppu.spr_ram, ppu.palette, ppu.chr,
+               ppu.vram]
+    for buffer in buffers:
+        crc = zlib.crc32(array_tobytes(buffer), crc)
+    return crc & 0xFFFFFFFF
+
+# NES.snapshot() is nested dicts, lists and tuples of numbers and arrays;
+# arrays and tuples are tagged to survive JSON.
+
+def _encode(obj):
+    if isinstance(obj, array):
+        data = array(obj.typecode, obj)
+        if sys.byteorder == 'big':
+            data.byteswap()
+        data = base64.b64encode(array_tobytes(data)).decode('ascii')
+        return {'array': obj.typecode, 'data': data}
+    if isinstance(obj, tuple):
+        return {'tuple': [_encode(item) for item in obj]}
+    if isinstance(obj, list):
+        return [_encode(item) for item in obj]
+    if isinstance(obj, dict):
+        return {'dict': dict((key, _encode(value))
+                             for key, value in obj.items())}
+    return obj
+
+def _decode(obj):
+    if isinstance(obj, list):
+        return [_decode(item) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if 'array' in obj:
+        data = array(str(obj['array']))
+        array_frombytes(data, base64.b64decode(obj['data']))
+        if sys.byteorder == 'big':
+            data.byteswap()
+        return data
+    if 'tuple' in obj:
+        return tuple(_decode(item) for item in obj['tuple'])
+    return dict((str(key), _decode(value))
+                for key, value in obj['dict'].items())
+
+def _upgrade_v1(snapshot):
+    # Version 1 snapshots have the PPU's memory as tiles and name tables
+    # rather than flat buffers. The checksums are over the same bytes in the
+    # same order, so they still hold.
+    ppu = snapshot['ppu']
+    ppu['chr'] = array('B')
+    for memory in ppu.pop('ptables'):
+        ppu['chr'].extend(memory)
+    ppu['vram'] = array('B')
+    for indexes, attribs in ppu.pop('ntables'):
+        ppu['vram'].extend(indexes)
+        ppu['vram'].extend(attribs)
+    ppu['palette'] = ppu.pop('bg_palette') + ppu.pop('spr_palette')
+    ppu['chr_banks'] = [0, 0x1000]
+
+class Replay(object):
+    VERSION = 2
+
+    def __init__(self, rom_sha1, engine, snapshot, interval):
+        self.rom_sha1 = rom_sha1
+        # The name of the PPU engine it was recorded with.
+        self.engine = engine
+        self.snapshot = snapshot
+        self.interval = interval
+        # The buttons of both joypads, for every frame after the snapshot.
+        self.inputs = []
+        # frame number -> state_checksum() after that frame
+        self.checksums = {}
+
+    @property
+    def start_frame(self):
+        return self.snapshot['frame_num']
+
+    def to_json(self):
+        inputs = bytearray()
+        for buttons in self.inputs:
+            inputs.extend(buttons)
+        return {
+            'version': Replay.VERSION,
+            'rom_sha1': self.rom_sha1,
+            'engine': self.engine,
+            'interval': self.interval,
+            'snapshot': _encode(self.snapshot),
+            'inputs': base64.b64encode(bytes(inputs)).decode('ascii'),
+            'checksums': sorted(self.checksums.items()),
+        }
+
+    @staticmethod
+    def from_json(obj):
+        version = obj.get('version')
+        if version not in (1, Replay.VERSION):
+            raise ReplayException('unsupported replay version: %r' % version)
+        snapshot = _decode(obj['snapshot'])
+        if version == 1:
+            _upgrade_v1(snapshot)
+        replay = Replay(obj['rom_sha1'], obj['engine'], snapshot,
+                        obj['interval'])
+        inputs = bytearray(base64.b64decode(obj['inputs']))
+        replay.inputs = [tuple(inputs[i:i + 2])
+                         for i in range(0, len(inputs), 2)]
+        replay.checksums = dict(
+            (frame_num, checksum) for frame_num, checksum in obj['checksums'])
+        return replay
+
+    def write(self, file):
+        file.write(_MAGIC)
+        file.write(zlib.compress(json.dumps(self.to_json()).encode('utf-8')))
+
+    @staticmethod
+    def read(file):
+        if file.read(len(_MAGIC)) != _MAGIC:
+            raise ReplayException('not a replay file')
+        try:
+            data = zlib.decompress(file.read())
+        except zlib.error as e:
+            raise ReplayException('corrupt replay: %s' % e)
+        return Replay.from_json(json.loads(data.decode('utf-8')))
+
+def rom_sha1(rom):
+    return hashlib.sha1(rom.raw).hexdigest()
+
+def rom_index(directory):
+    # SHA-1 -> path for the .nes files in directory.
+    roms = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.lower().endswith('.nes'):
+            with open(path, 'rb') as file:
+                roms[hashlib.sha1(file.read()).hexdigest()] = path
+    return roms
+
+class ReplayRecorder(object):
+    """
+    Records a replay of the frames the NES emulates while attached.
+
+    Like annyong.heatmap.Heatmap, attaching replaces emulate_frame() on the
+    NES instance. The buttons are taken at the start of every frame, so
+    changes to them should be made between frames. A frame that a debugger
+    break interrupts is recorded once it's finished.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.nes = None
+        self.replay = None
+
+    def attach(self, nes):
+        assert self.nes is None
+        if nes.run_ahead:
+            raise ValueError("run-ahead frames can't be recorded")
+        self.nes = nes
+        self.replay = Replay(rom_sha1(nes.rom), nes.engine.name,
+                             nes.snapshot(), self.interval)
+        emulate_frame = nes.emulate_frame
+        replay = self.replay
+
+        def recording_emulate_frame():
+            if not nes.mid_frame:
+                replay.inputs.append(tuple(c.buttons
+                                           for c in nes.controllers))
+            emulate_frame()
+            if nes.frame_num % replay.interval == 0:
+                replay.checksums[nes.frame_num] = state_checksum(nes)
+
+        nes.emulate_frame = recording_emulate_frame
+
+    def detach(self):
+        assert self.nes is not None
+        del self.nes.emulate_frame
+        self.nes = None
+        return self.replay
+
+def play(nes, replay, verify=True):
+    """
+    Plays replay on nes (which has to have the same ROM loaded), through
+    NES.frame() so sinks see the frames. With verify, the checksums are
+    compared as it goes; the frame number of the first mismatch is returned,
+    or None when everything matched.
+
+    The checksums cover PPU state whose timing differs between engines
+    (e.g. loopy_v), so verifying requires the engine the replay was recorded
+    with; bin/divergence compares engines.
+    """
+    if rom_sha1(nes.rom) != replay.rom_sha1:
+        raise ReplayException('the replay is for another ROM (%s)' %
+                              replay.rom_sha1)
+    if verify and nes.engine.name != replay.engine:
+        raise ReplayException(
+            'the replay was recorded with the %s engine; its checksums '
+            "can't be verified with %s (see bin/divergence)" %
+            (replay.engine, nes.engine.name))
+    nes.restore(replay.snapshot)
+    for buttons in replay.inputs:
+        for controller, pressed in zip(nes.controllers, buttons):
+            controller.buttons = pressed
+        nes.frame()
+        if not verify or nes.frame_num not in replay.checksums:
+            continue
+        if state_checksum(nes) != replay.checksums[nes.frame_num]:
+            return nes.frame_num
+    return None
@@ -1,5 +1,6 @@
 import struct
-from StringIO import StringIO
+
+from annyong.util.compat import BytesIO, xrange
 
 class Rom(object):
     class InvalidRomException(BaseException):
@@ -27,10 +28,10 @@ class Rom(object):
     def load_raw(self, raw):
         self.reset()
         self.raw = raw
-        raw = StringIO(raw)
+        raw = BytesIO(raw)
 
         # Bytes 0-4
-        if not raw.read(4).startswith('NES\x1a'):
+        if not raw.read(4).startswith(b'NES\x1a'):
             raise Rom.InvalidRomException('doesn\'t seem to be a .nes file')
 
         # Bytes 4-8
@@ -0,0 +1,83 @@
+from timeit import default_timer
+
+from annyong.util.compat import xrange
+
+class RunAhead(object):
+    """
+    Hides input lag by presenting a frame from the future.
+
+    Every host frame emulates the real frame headless, saves the state, runs
+    `frames` frames ahead (only the last one rendered), keeps that screen and
+    restores the saved state. The time spent is accumulated so stats() can
+    tell how much of the frame budget this eats.
+    """
+
+    def __init__(self, nes, frames):
+        assert frames > 0
+        self.nes = nes
+        self.frames = frames
+        self.num_frames = None
+        self.emulate_time = None
+        self.ahead_time = None
+        self.snapshot_time = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_frames = 0
+        self.emulate_time = 0.0
+        self.ahead_time = 0.0
+        self.snapshot_time = 0.0
+
+    def frame(self):
+        nes = self.nes
+        ppu = nes.ppu
+        skip_rendering = ppu.skip_rendering
+
+        start = default_timer()
+        ppu.skip_rendering = True
+        nes.emulate_frame()
+        emulated = default_timer()
+
+        state = nes.snapshot()
+        saved = default_timer()
+
+        # Frames that are thrown away shouldn't end up in the trace.
+        logfile, nes.logfile = nes.logfile, None
+        try:
+            for i in xrange(self.frames - 1):
+                nes.emulate_frame()
+            ppu.skip_rendering = skip_rendering
+            nes.emulate_frame()
+        finally:
+            nes.logfile = logfile
+            ppu.skip_rendering = skip_rendering
+        ahead = default_timer()
+
+        screen = ppu.screen[:]
+        nes.restore(state)
+        ppu.screen[:] = screen
+        restored = default_timer()
+
+        self.num_frames += 1
+        self.emulate_time += emulated - start
+        self.ahead_time += ahead - saved
+        self.snapshot_time += (saved - emulated) + (restored - ahead)
+
+    def stats(self):
+        n = self.num_frames or 1
+        emulate = self.emulate_time / n
+        ahead = self.ahead_time / n
+        snapshot = self.snapshot_time / n
+        frame_time = self.nes.FRAME_TIME
+        return {
+            'frames': self.num_frames,
+            'run_ahead': self.frames,
+            'emulate_time': emulate,
+            'ahead_time': ahead,
+            'snapshot_time': snapshot,
+            'frame_budget': frame_time,
+            # Fraction of a real time frame used in total, and by run-ahead
+            # alone. Above 1.0 means we can't keep up.
+            'budget_used': (emulate + ahead + snapshot) / frame_time,
+            'run_ahead_cost': (ahead + snapshot) / frame_time,
+        }
@@ -0,0 +1,301 @@
+"""
+A control server for a running NES.
+
+Clients connect over TCP ('host:port') or a Unix socket (a path) and send one
+JSON object per line: {"id": 1, "method": "read", "params": {...}}. Every
+request gets one line back, {"id": 1, "result": ...} or {"id": 1, "error":
+"..."}. When a breakpoint stops a running NES, every client also gets
+{"event": "break", ...}.
+
+Methods:
+    status                      running, frame, pc
+    pause, resume
+    step {instructions: N}      or {frames: N} whole frames, after finishing
+                                the current one; only while paused
+    registers                   pc, sp, a, x, y, ps, cycles
+    read {address, length}      data as hex, without side effects
+    write {address, data}       hex data, straight into memory
+    snapshot {name}, restore {name}
+    frame {format}              'indices' (default), 'rgb' or 'png', base64
+    input {port, buttons}       joypad buttons held from now on, names from
+                                annyong.controller.BUTTONS
+    breakpoint {pc}, clear      see annyong.debugger
+    quit                        stops the server
+
+The emulator runs `slice_frames` frames at a time and only looks at the
+sockets in between, so the traffic doesn't slow the emulation down. Other
+socket users (e.g. annyong.stream.StreamSink) can be passed as `services`,
+which have sockets() and poll(nes) methods: their sockets are waited on along
+with the clients', so they're serviced while paused too.
+"""
+
+import base64
+import binascii
+import json
+import os
+import select
+import socket
+
+from annyong.controller import BUTTONS, buttons_mask
+from annyong.ppu.palette import screen_to_rgb
+from annyong.util.compat import array_tobytes
+from annyong.util.png import encode_png
+
+class ServerException(BaseException):
+    pass
+
+def parse_address(address):
+    # (family, address) for 'host:port', ':port' or a Unix socket path.
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+class Client(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def send(self, obj):
+        self.sock.sendall((json.dumps(obj) + '\n').encode('utf-8'))
+
+class ControlServer(object):
+    def __init__(self, nes, address, slice_frames=1, services=()):
+        self.nes = nes
+        self.address = address
+        self.slice_frames = slice_frames
+        self.services = list(services)
+        self.running = True
+        self.stopped = False
+        self.clients = []
+        self.snapshots = {}
+        self.listener = None
+
+    def listen(self):
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                     1)
+        self.listener.bind(address)
+        self.listener.listen(5)
+
+    def serve_forever(self):
+        if not self.listener:
+            self.listen()
+        try:
+            while not self.stopped:
+                self.poll(0 if self.running else None)
+                if self.running and not self.stopped:
+                    self.run_slice()
+        finally:
+            self.close()
+
+    def poll(self, timeout):
+        socks = [self.listener] + [client.sock for client in self.clients]
+        service_socks = [service.sockets() for service in self.services]
+        readable, writable, _ = select.select(
+            socks + [sock for r, _ in service_socks for sock in r],
+            [sock for _, w in service_socks for sock in w], [], timeout)
+        for sock in readable:
+            if sock is self.listener:
+                conn, _ = self.listener.accept()
+                self.clients.append(Client(conn))
+                continue
+            clients = [c for c in self.clients if c.sock is sock]
+            if clients:
+                self.read_client(clients[0])
+
+        ready = set(readable) | set(writable)
+        for service, (r, w) in zip(self.services, service_socks):
+            if ready.intersection(r + w):
+                service.poll(self.nes)
+
+    def run_slice(self):
+        e = self.nes.debugger.run(self.slice_frames)
+        if e:
+            self.running = False
+            self.broadcast(dict(self.describe_break(e), event='break'))
+
+    def read_client(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except socket.error:
+            data = b''
+        if not data:
+            self.drop(client)
+            return
+
+        client.buffer += data
+        while b'\n' in client.buffer:
+            line, client.buffer = client.buffer.split(b'\n', 1)
+            if line.strip():
+                self.handle_line(client, line.decode('utf-8'))
+
+    def handle_line(self, client, line):
+        id = None
+        try:
+            request = json.loads(line)
+            id = request.get('id')
+            method = getattr(self, 'do_%s' % request.get('method'), None)
+            if method is None:
+                raise ServerException('unknown method: %r' %
+                                      request.get('method'))
+            result = method(**request.get('params', {}))
+            response = {'id': id, 'result': result}
+        except ServerException as e:
+            response = {'id': id, 'error': str(e)}
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            response = {'id': id, 'error': 'bad request: %s' % e}
+
+        try:
+            client.send(response)
+        except socket.error:
+            self.drop(client)
+
+    def broadcast(self, obj):
+        for client in self.clients[:]:
+            try:
+                client.send(obj)
+            except socket.error:
+                self.drop(client)
+
+    def drop(self, client):
+        client.sock.close()
+        self.clients.remove(client)
+
+    def close(self):
+        for client in self.clients[:]:
+            self.drop(client)
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+            family, address = parse_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(address):
+                os.unlink(address)
+
+    def describe_break(self, e):
+        info = {'reason': e.reason, 'pc': e.pc}
+        if e.address is not None:
+            info['address'] = e.address
+            info['value'] = e.value
+        return info
+
+    def _require_paused(self):
+        if self.running:
+            raise ServerException('pause first')
+
+    # methods {{{
+
+    def do_status(self):
+        return {
+            'running': self.running,
+            'frame': self.nes.frame_num,
+            'pc': self.nes.mpu.reg.pc,
+        }
+
+    def do_pause(self):
+        self.running = False
+        return self.do_status()
+
+    def do_resume(self):
+        self.running = True
+        return self.do_status()
+
+    def do_step(self, instructions=None, frames=None):
+        self._require_paused()
+        if instructions is not None:
+            e = self.nes.debugger.step(instructions)
+            if e and e.reason == 'step':
+                e = None
+        else:
+            # Stopped mid-frame (by a breakpoint or an instruction step),
+            # the rest of that frame doesn't count as one of them.
+            frames = frames or 1
+            if self.nes.mid_frame:
+                frames += 1
+            e = self.nes.debugger.run(frames)
+        result = self.do_status()
+        if e:
+            result['break'] = self.describe_break(e)
+        return result
+
+    def do_registers(self):
+        mpu = self.nes.mpu
+        return {
+            'pc': mpu.reg.pc, 'sp': mpu.reg.sp, 'a': mpu.reg.ac,
+            'x': mpu.reg.x, 'y': mpu.reg.y, 'ps': int(mpu.reg.ps),
+            'cycles': mpu.cycles,
+        }
+
+    def do_read(self, address, length=1):
+        memory = self.nes.mpu.memory
+        if not 0 <= address <= address + length <= 0x10000:
+            raise ServerException('out of range')
+        data = array_tobytes(memory.peek_block(address, length))
+        return {
+            'address': address,
+            'data': binascii.hexlify(data).decode('ascii'),
+        }
+
+    def do_write(self, address, data):
+        memory = self.nes.mpu.memory
+        data = bytearray(binascii.unhexlify(data))
+        if not 0 <= address <= address + len(data) <= 0x10000:
+            raise ServerException('out of range')
+        memory.poke_block(address, data)
+        return {'address': address, 'length': len(data)}
+
+    def do_snapshot(self, name):
+        self.snapshots[name] = self.nes.snapshot()
+        return {'name': name, 'frame': self.nes.frame_num}
+
+    def do_restore(self, name):
+        if name not in self.snapshots:
+            raise ServerException('no snapshot named %r' % name)
+        self.nes.restore(self.snapshots[name])
+        return self.do_status()
+
+    def do_frame(self, format='indices'):
+        ppu = self.nes.ppu
+        if format == 'indices':
+            data = array_tobytes(ppu.screen)
+        elif format == 'rgb':
+            data = bytes(screen_to_rgb(ppu))
+        elif format == 'png':
+            data = encode_png(256, 240, screen_to_rgb(ppu))
+        else:
+            raise ServerException('unknown format: %r' % format)
+        return {
+            'frame': self.nes.frame_num,
+            'width': 256,
+            'height': 240,
+            'format': format,
+            'data': base64.b64encode(data).decode('ascii'),
+        }
+
+    def do_input(self, buttons, port=0):
+        if port not in (0, 1):
+            raise ServerException('no joypad %r' % port)
+        unknown = set(buttons) - set(BUTTONS)
+        if unknown:
+            raise ServerException('unknown buttons: %s' %
+                                  ', '.join(sorted(unknown)))
+        self.nes.controllers[port].buttons = buttons_mask(buttons)
+        return {'port': port, 'buttons': sorted(buttons)}
+
+    def do_breakpoint(self, pc):
+        self.nes.debugger.add_breakpoint(pc)
+        return {'pc': pc}
+
+    def do_clear(self):
+        self.nes.debugger.clear()
+        return {}
+
+    def do_quit(self):
+        self.stopped = True
+        return {}
+
+    # }}}
@@ -0,0 +1,98 @@
+"""
+Frame sinks consume the frames produced by NES.frame().
+
+A sink is any callable taking the NES; it's called after every frame that was
+drawn (see NES.add_sink()). Sinks that hold on to files also have a close().
+"""
+
+import hashlib
+import sys
+
+from annyong.ppu.palette import screen_to_rgb
+from annyong.util.compat import array_tobytes, xrange
+from annyong.util.png import write_png
+
+def format_buffer(buffer, w, h):
+    ret = ''
+    for y in xrange(h):
+        for x in xrange(w):
+            ret += str(buffer[y * w + x])
+        ret += '\n'
+    return ret.replace('0', '.').strip()
+
+class NullSink(object):
+    def __call__(self, nes):
+        pass
+
+    def close(self):
+        pass
+
+class HashSink(object):
+    # Keeps (frame number, digest) of every frame's screen, and writes them
+    # as lines to `file` if given.
+    def __init__(self, file=None, algorithm='md5'):
+        self.file = file
+        self.algorithm = algorithm
+        self.digests = []
+
+    def __call__(self, nes):
+        screen = array_tobytes(nes.ppu.screen)
+        digest = hashlib.new(self.algorithm, screen).hexdigest()
+        self.digests.append((nes.frame_num, digest))
+        if self.file:
+            self.file.write('%d %s\n' % (nes.frame_num, digest))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+class PngSink(object):
+    # Writes every frame to pattern % frame number.
+    def __init__(self, pattern='frame%05d.png'):
+        self.pattern = pattern
+
+    def __call__(self, nes):
+        write_png(self.pattern % nes.frame_num, 256, 240,
+                  screen_to_rgb(nes.ppu))
+
+    def close(self):
+        pass
+
+class RawVideoSink(object):
+    # Appends every frame as 256x240 rgb24, e.g. for
+    # `ffmpeg -f rawvideo -pix_fmt rgb24 -s 256x240 -r 60 -i FILE`.
+    def __init__(self, file):
+        self.file = file
+        self._rgb = bytearray(256 * 240 * 3)
+
+    def __call__(self, nes):
+        self.file.write(screen_to_rgb(nes.ppu, self._rgb))
+
+    def close(self):
+        self.file.close()
+
+class AsciiDumpSink(object):
+    # Prints the screen, name tables and pattern tables as text.
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def __call__(self, nes):
+        write = self.stream.write
+        ppu = nes.ppu
+
+        write('Frame %04d\n' % nes.frame_num)
+        write('Screen\n')
+        write(format_buffer(ppu.screen, 256, 240) + '\n')
+
+        buffers = ppu.render_nametable()
+        for base, buffer in buffers.items():
+            write('Name table %04X\n' % base)
+            write(format_buffer(buffer, 256, 240) + '\n')
+
+        buffers = ppu.render_pattern_tables()
+        for base, buffer in buffers.items():
+            write('Pattern table %04X\n' % base)
+            write(format_buffer(buffer, 128, 128) + '\n')
+
+    def close(self):
+        self.stream.flush()
@@ -0,0 +1,255 @@
+"""
+Streams the screen to viewers over TCP or a Unix socket, as a frame sink.
+
+Viewers connect to the address and just read: the stream starts with
+'ANST' and a version byte, followed by a packet per frame. A packet is
+_HEADER (body length, kind, frame number) and a zlib compressed body: the 4
+colors the screen's 2 bit pixels stand for (indexes into
+annyong.ppu.palette.NES_PALETTE), then either the whole 256x240 screen
+(KEYFRAME) or, for every row that changed since the last frame that viewer
+got, the row number and the row (DELTA). StreamDecoder puts them back
+together.
+
+Every viewer gets a keyframe first and then every `keyframe_interval`
+frames. Sockets are never waited on: a viewer that hasn't taken the last
+packet yet simply misses frames, and its next delta is against the last frame
+it did get.
+"""
+
+import errno
+import os
+import select
+import socket
+import struct
+import zlib
+from array import array
+
+from annyong.ppu.palette import NES_PALETTE, translate_planes
+from annyong.server import parse_address
+from annyong.util.compat import array_tobytes, xrange
+
+MAGIC = b'ANST\x01'
+KEYFRAME = 0
+DELTA = 1
+
+_HEADER = struct.Struct('<IBI')
+_ROW = 256
+
+class StreamException(BaseException):
+    pass
+
+class Viewer(object):
+    def __init__(self, sock):
+        self.sock = sock
+        # Bytes the socket hasn't taken yet.
+        self.pending = bytearray(MAGIC)
+        # The last screen it was sent, which deltas are against.
+        self.base = None
+        self.frames_since_keyframe = 0
+
+class StreamSink(object):
+    def __init__(self, address, keyframe_interval=60, level=6):
+        self.address = address
+        self.keyframe_interval = keyframe_interval
+        self.level = level
+        self.viewers = []
+        # Totals over all viewers.
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.keyframes_sent = 0
+        self.bytes_sent = 0
+
+        family, address = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                     1)
+        self.listener.bind(address)
+        self.listener.listen(5)
+        self.listener.setblocking(False)
+
+    def __call__(self, nes):
+        self.poll()
+        self._send_frame(nes, self.viewers[:])
+
+    def _send_frame(self, nes, viewers):
+        if not viewers:
+            return
+
+        screen = array_tobytes(nes.ppu.screen)
+        colors = bytes(bytearray(nes.ppu.palette[i] & 0x3F
+                                 for i in xrange(4)))
+        # Viewers that got the same last frame share the encoding.
+        packets = {}
+        for viewer in viewers:
+            # A new viewer gets its keyframe even if the socket hasn't taken
+            # MAGIC yet.
+            if viewer.pending and viewer.base is not None:
+                self.frames_dropped += 1
+                continue
+            keyframe = (viewer.base is None or
+                        viewer.frames_since_keyframe >=
+                        self.keyframe_interval)
+            key = None if keyframe else id(viewer.base)
+            if key not in packets:
+                packets[key] = self._encode(nes.frame_num, screen, colors,
+                                            None if keyframe else viewer.base)
+            if keyframe:
+                self.keyframes_sent += 1
+                viewer.frames_since_keyframe = 0
+            viewer.frames_since_keyframe += 1
+            viewer.base = screen
+            viewer.pending += packets[key]
+            self.frames_sent += 1
+            self._send(viewer)
+
+    def _encode(self, frame_num, screen, colors, base):
+        if base is None:
+            kind, body = KEYFRAME, colors + screen
+        else:
+            kind, parts = DELTA, [colors]
+            for y in xrange(240):
+                row = screen[y * _ROW:(y + 1) * _ROW]
+                if row != base[y * _ROW:(y + 1) * _ROW]:
+                    parts.append(struct.pack('B', y))
+                    parts.append(row)
+            body = b''.join(parts)
+        body = zlib.compress(body, self.level)
+        return _HEADER.pack(len(body), kind, frame_num) + body
+
+    def sockets(self):
+        # (sockets to read, sockets to write) for when something else waits
+        # on them; poll() once any of them is ready.
+        return ([self.listener] + [viewer.sock for viewer in self.viewers],
+                [viewer.sock for viewer in self.viewers if viewer.pending])
+
+    def poll(self, nes=None):
+        # Takes new viewers, notices the ones that went away and sends what
+        # the others have pending; all without blocking. When the NES isn't
+        # drawing frames (e.g. it's paused), pass it so new viewers get its
+        # screen as their keyframe right away.
+        reads, writes = self.sockets()
+        readable, writable, _ = select.select(reads, writes, [], 0)
+        for sock in readable:
+            if sock is self.listener:
+                try:
+                    conn, _ = self.listener.accept()
+                except socket.error:
+                    continue
+                conn.setblocking(False)
+                viewer = Viewer(conn)
+                self.viewers.append(viewer)
+                self._send(viewer)
+                continue
+            viewer = self._viewer(sock)
+            try:
+                data = sock.recv(4096)
+            except socket.error:
+                data = b''
+            # Viewers don't send anything; whatever they do is ignored.
+            if not data:
+                self.drop(viewer)
+        for sock in writable:
+            viewer = self._viewer(sock)
+            if viewer:
+                self._send(viewer)
+        if nes is not None:
+            self._send_frame(nes, [viewer for viewer in self.viewers
+                                   if viewer.base is None])
+
+    def _viewer(self, sock):
+        for viewer in self.viewers:
+            if viewer.sock is sock:
+                return viewer
+        return None
+
+    def _send(self, viewer):
+        try:
+            sent = viewer.sock.send(viewer.pending)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.drop(viewer)
+            return
+        del viewer.pending[:sent]
+        self.bytes_sent += sent
+
+    def drop(self, viewer):
+        viewer.sock.close()
+        self.viewers.remove(viewer)
+
+    def stats(self):
+        return {
+            'viewers': len(self.viewers),
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'keyframes_sent': self.keyframes_sent,
+            'bytes_sent': self.bytes_sent,
+        }
+
+    def close(self):
+        for viewer in self.viewers[:]:
+            self.drop(viewer)
+        self.listener.close()
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+
+class StreamDecoder(object):
+    """
+    The viewer's side: feed() it what the socket gives, and screen and
+    colors are kept up to date.
+    """
+
+    def __init__(self):
+        self.screen = bytearray(256 * 240)
+        self.colors = bytearray(4)
+        self.frame_num = None
+        self.keyframes = 0
+        self._buffer = b''
+        self._started = False
+
+    def feed(self, data):
+        # Returns the frame numbers of the packets completed by data.
+        self._buffer += data
+        if not self._started:
+            if len(self._buffer) < len(MAGIC):
+                return []
+            if self._buffer[:len(MAGIC)] != MAGIC:
+                raise StreamException('not a frame stream')
+            self._buffer = self._buffer[len(MAGIC):]
+            self._started = True
+
+        frames = []
+        while len(self._buffer) >= _HEADER.size:
+            length, kind, frame_num = _HEADER.unpack(
+                self._buffer[:_HEADER.size])
+            end = _HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            body = zlib.decompress(self._buffer[_HEADER.size:end])
+            self._buffer = self._buffer[end:]
+            self._apply(kind, bytearray(body))
+            self.frame_num = frame_num
+            frames.append(frame_num)
+        return frames
+
+    def _apply(self, kind, body):
+        self.colors[:] = body[:4]
+        if kind == KEYFRAME:
+            self.screen[:] = body[4:]
+            self.keyframes += 1
+            return
+        if self.frame_num is None:
+            raise StreamException('delta before the first keyframe')
+        for pos in xrange(4, len(body), _ROW + 1):
+            y = body[pos]
+            self.screen[y * _ROW:(y + 1) * _ROW] = body[pos + 1:
+                                                        pos + 1 + _ROW]
+
+    def rgb(self):
+        # The screen as packed 24 bit RGB, like screen_to_rgb().
+        colors = [NES_PALETTE[color] for color in self.colors]
+        return translate_planes(array('B', self.screen), list(zip(*colors)))
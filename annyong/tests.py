@@ -1,9 +1,12 @@
-from __future__ import absolute_import
-
-from StringIO import StringIO
+from __future__ import absolute_import, print_function
 
+from annyong.heatmap import Heatmap, HeatmapException
 from annyong.nes import NES
 from annyong.mpu.mpu6502 import Mpu6502
+from annyong.mpu.profiler import Profiler, ProfilerException
+from annyong.ppu.engine import ENGINES
+from annyong.sinks import HashSink
+from annyong.util.compat import StringIO, xrange
 
 def run_nestest(rom_path):
     # This test compares the trace output of our mpu and nestest.log, so we need
@@ -37,15 +40,92 @@ def run_nestest(rom_path):
     # trace_lines will contain more lines than correct_lines.
     for i in xrange(len(correct_lines)):
         if i >= len(trace_lines):
-            print "ERROR: Not enough lines in trace."
-            print "Correct: %d, Trace: %d" % (
+            print("ERROR: Not enough lines in trace.")
+            print("Correct: %d, Trace: %d" % (
                 len(correct_lines), len(trace_lines)
-            )
+            ))
             break
         if trace_lines[i].strip() != correct_lines[i].strip():
-            print "Error on line %d" % i
-            print 'trace  ', trace_lines[i]
-            print 'nestest', correct_lines[i]
+            print("Error on line %d" % i)
+            print('trace  ', trace_lines[i])
+            print('nestest', correct_lines[i])
             break
     else:
-        print "%d lines correct!" % len(correct_lines)
+        print("%d lines correct!" % len(correct_lines))
+
+def run_digest_test(rom_path, digests_path, engines=None):
+    # Runs the ROM on every PPU engine (without input) and compares the
+    # digest of every frame with digests_path, which is what --hash wrote
+    # for a run that's known to be right. Returns whether all of them match.
+    with open(digests_path, 'r') as file:
+        correct = [tuple(line.split()) for line in file if line.strip()]
+
+    ok = True
+    for engine in engines or sorted(ENGINES):
+        sink = HashSink()
+        nes = NES(engine=engine)
+        nes.load_rom(rom_path)
+        nes.add_sink(sink)
+        nes.start(len(correct))
+
+        digests = [('%d' % frame_num, digest)
+                   for frame_num, digest in sink.digests]
+        for expected, actual in zip(correct, digests):
+            if expected != actual:
+                print("%s: error on frame %s" % (engine, expected[0]))
+                print('digest ', actual[1])
+                print('correct', expected[1])
+                ok = False
+                break
+        else:
+            print("%s: %d frames correct!" % (engine, len(correct)))
+    return ok
+
+def run_detach_test(rom_path):
+    # Attaches a profiler and a heatmap in both orders, and checks that
+    # detaching the first one attached refuses to, and that detaching them
+    # in reverse leaves the mpu and memory as they were. Returns whether it
+    # all went that way.
+    ok = True
+    for first in ('profiler', 'heatmap'):
+        nes = NES()
+        nes.load_rom(rom_path)
+        mpu, memory = nes.mpu, nes.mpu.memory
+        profiler, heatmap = Profiler(), Heatmap()
+        tools = {
+            'profiler': (profiler, lambda: profiler.attach(mpu),
+                         ProfilerException),
+            'heatmap': (heatmap, lambda: heatmap.attach(memory),
+                        HeatmapException),
+        }
+        order = [first, 'heatmap' if first == 'profiler' else 'profiler']
+        for name in order:
+            tools[name][1]()
+        nes.start(1)
+
+        errors = []
+        tool, _, exception = tools[order[0]]
+        try:
+            tool.detach()
+            errors.append('%s detached under the %s' % tuple(order))
+        except exception:
+            pass
+        for name in reversed(order):
+            tools[name][0].detach()
+
+        counts = (sum(profiler.opcode_counts), sum(heatmap.counters['reads']))
+        nes.run_frames(1)
+        if (sum(profiler.opcode_counts), sum(heatmap.counters['reads'])) != \
+                counts:
+            errors.append('counted after detach()')
+        for obj, names in ((mpu, ('execute_opcode',)),
+                           (memory, ('get_byte', 'set_byte'))):
+            errors.extend('%s left on the instance' % name
+                          for name in names if name in vars(obj))
+
+        if errors:
+            ok = False
+            print("%s first: %s" % (first, ', '.join(errors)))
+        else:
+            print("%s first: detached correctly!" % first)
+    return ok
@@ -1,16 +1,12 @@
-import struct
-
 def bcd2bin(bcd):
-    h = '%02x' % bcd
-    assert len(h) == 2
-    assert h.isdigit(), h
-    return int(h, 10)
+    high, low = bcd >> 4, bcd & 0xF
+    assert 0 <= bcd <= 0x99 and low <= 9, hex(bcd)
+    return high * 10 + low
 
 def bin2bcd(bin):
-    d = '%02d' % bin
-    assert len(d) == 2
-    return int(d, 16)
+    assert 0 <= bin <= 99
+    return ((bin // 10) << 4) | (bin % 10)
 
 def signed_byte(byte):
     assert 0 <= byte <= 255
-    return struct.unpack('b', chr(byte))[0]
+    return byte - 256 if byte & 0x80 else byte
@@ -16,8 +16,9 @@ class Bitset(object):
         self._size = pos
         self._initialized = True
 
-    def __trunc__(self):
+    def __int__(self):
         return self._num
+    __trunc__ = __index__ = __int__
 
     def __len__(self):
         return self._size
@@ -26,8 +27,11 @@ class Bitset(object):
         return str(self._num)
     __repr__ = __str__
 
+    # _format is looked up in __dict__ directly: going through hasattr()
+    # before __init__ has set it recurses through __getattr__ until the
+    # recursion limit.
     def __setattr__(self, key, value):
-        if hasattr(self, '_format') and key in self._format:
+        if key in self.__dict__.get('_format', ()):
             value = int(value)
             item = self._format[key]
             self._num &= ~item['mask']
@@ -35,13 +39,13 @@ class Bitset(object):
         elif hasattr(self, key) or not hasattr(self, '_initialized'):
             super(Bitset, self).__setattr__(key, value)
         else:
-            raise AttributeError, key
+            raise AttributeError(key)
 
     def __getattr__(self, key):
-        if hasattr(self, '_format') and key in self._format:
+        if key in self.__dict__.get('_format', ()):
             item = self._format[key]
             return (self._num & item['mask']) >> item['pos']
-        raise AttributeError, key
+        raise AttributeError(key)
 
     def set(self, num):
         self._num = num
@@ -0,0 +1,32 @@
+"""
+The differences between Python 2 and 3 that matter here, so the emulator
+runs on CPython 2.7, CPython 3 and PyPy alike.
+"""
+
+import sys
+
+PY3 = sys.version_info[0] >= 3
+
+if PY3:
+    import queue
+    from io import BytesIO, StringIO
+
+    xrange = range
+
+    def array_tobytes(arr):
+        return arr.tobytes()
+
+    def array_frombytes(arr, data):
+        arr.frombytes(data)
+else:
+    import Queue as queue
+    from StringIO import StringIO
+    BytesIO = StringIO
+
+    xrange = xrange
+
+    def array_tobytes(arr):
+        return arr.tostring()
+
+    def array_frombytes(arr, data):
+        arr.fromstring(data)
@@ -0,0 +1,39 @@
+import struct
+import zlib
+
+from annyong.util.compat import xrange
+
+# IHDR color types
+GRAYSCALE = 0
+RGB = 2
+
+_CHANNELS = {
+    GRAYSCALE: 1,
+    RGB: 3,
+}
+
+def _chunk(type, data):
+    crc = zlib.crc32(type + data) & 0xFFFFFFFF
+    return struct.pack('>I', len(data)) + type + data + struct.pack('>I', crc)
+
+def encode_png(width, height, pixels, color_type=RGB, level=6):
+    # pixels is a packed 8 bit per channel buffer, rows top to bottom.
+    stride = width * _CHANNELS[color_type]
+    pixels = bytes(pixels)
+    assert len(pixels) == stride * height
+
+    # Every row is prefixed with filter type 0 (none).
+    raw = b''.join(b'\x00' + pixels[y * stride:(y + 1) * stride]
+                   for y in xrange(height))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        _chunk(b'IHDR', header),
+        _chunk(b'IDAT', zlib.compress(raw, level)),
+        _chunk(b'IEND', b''),
+    ])
+
+def write_png(path, width, height, pixels, color_type=RGB, level=6):
+    with open(path, 'wb') as file:
+        file.write(encode_png(width, height, pixels, color_type, level))